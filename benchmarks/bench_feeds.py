@@ -0,0 +1,284 @@
+"""
+Benchmarks the iCal and JSON preview endpoints against local stand-ins for
+Trakt, TMDB and MongoDB.
+
+Every combination of calendar window and show count is measured with cold
+caches (all caches emptied before each request) and warm caches (one
+unmeasured request first). For each scenario the p50/p99 latency, upstream
+calls per request and peak Python heap growth are reported.
+
+    python benchmarks/bench_feeds.py --shows 10,100 --latency 20
+    python benchmarks/bench_feeds.py --json results.json
+    python benchmarks/bench_feeds.py --baseline results.json --tolerance 0.25
+
+With --baseline the run exits non-zero if any scenario makes more upstream
+calls than the baseline, or its p99 grows by more than the tolerance (and
+by more than P99_NOISE_MS, so sub-millisecond jitter on warm scenarios is
+ignored).
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cryptography.fernet import Fernet
+
+from stubs import MemoryCollection, TMDBStub, TraktStub, make_token
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# p99 changes smaller than this are treated as noise by --baseline.
+P99_NOISE_MS = 5
+
+USER_KEY = "benchmark"
+ENDPOINTS = {
+    "ics": "/{calendar_type}?key={key}&days_ago={days_ago}&period={period}",
+    "json": "/{calendar_type}/json?key={key}&days_ago={days_ago}&period={period}",
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--windows",
+        default="7:30,30:90",
+        help="Comma separated days_ago:period windows (default 7:30,30:90)",
+    )
+    parser.add_argument("--shows", default="10,100", help="Comma separated show counts")
+    parser.add_argument(
+        "--movies", type=int, default=5, help="Movies released per 30 days"
+    )
+    parser.add_argument(
+        "--types", default="shows,movies", help="Comma separated calendar types"
+    )
+    parser.add_argument(
+        "--endpoints", default="ics,json", help="Comma separated: ics, json"
+    )
+    parser.add_argument(
+        "--requests", type=int, default=20, help="Measured requests per scenario"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Upstream latency in milliseconds"
+    )
+    parser.add_argument(
+        "--payload", type=int, default=256, help="Padding bytes per upstream item"
+    )
+    parser.add_argument("--json", help="Write the results to this file")
+    parser.add_argument("--baseline", help="Compare against a previous --json file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Allowed relative p99 regression against --baseline",
+    )
+    return parser.parse_args(argv)
+
+
+def percentile(values, pct: float):
+    """
+    Returns the nearest-rank percentile of values
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def setup_app(workdir: str, trakt: TraktStub, tmdb: TMDBStub):
+    """
+    Points the app at the stubs and a scratch directory, imports it and
+    swaps its Mongo collection for an in-memory one
+    """
+    os.environ.update(
+        {
+            "TRAKT_API_URL": trakt.url,
+            "TRAKT_URL": trakt.url,
+            "TRAKT_CLIENT_ID": "benchmark",
+            "TRAKT_CLIENT_SECRET": "benchmark",
+            "TMDB_API_URL": f"{tmdb.url}/3",
+            "TMDB_ACCESS_TOKEN": "benchmark",
+            "TRAKT_CACHE_PATH": os.path.join(workdir, "trakt.sqlite3"),
+            "TMDB_CACHE_PATH": os.path.join(workdir, "tmdb.sqlite3"),
+            "LOCK_DIR": os.path.join(workdir, "locks"),
+            "HOST": "http://127.0.0.1",
+            # Measure the app, not the upstream budget
+            "TRAKT_RATE_LIMIT": "0",
+            "TMDB_RATE_LIMIT": "0",
+        }
+    )
+    os.environ.setdefault("SECRET_KEY", Fernet.generate_key().decode())
+    os.environ.pop("SENTRY_DSN", None)
+    # The Flask cache lives in ./cache relative to the working directory
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(ROOT, "trakt_ical"))
+    logging.disable(logging.WARNING)
+
+    import serve_ical  # pylint: disable=import-outside-toplevel
+    from util import encrypt  # pylint: disable=import-outside-toplevel
+
+    col = MemoryCollection()
+    col.insert_one(
+        {"user_id": USER_KEY, "user_slug": "benchmark", "token": encrypt(make_token())}
+    )
+    serve_ical.get_collection = lambda: col
+    return serve_ical
+
+
+def clear_caches(serve_ical):
+    """
+    Empties every cache a request could be served from
+    """
+    import tmdb_api  # pylint: disable=import-outside-toplevel
+    import trakt_api  # pylint: disable=import-outside-toplevel
+
+    with serve_ical.app.app_context():
+        serve_ical.get_cache().clear()
+    serve_ical.tokens.pop(USER_KEY)
+    serve_ical.profiles.pop(USER_KEY)
+    trakt_api.get_bucket_cache().clear()
+    tmdb_api.get_cache().clear()
+
+
+def run_scenario(serve_ical, client, stubs, path: str, cold: bool, requests: int):
+    """
+    Requests path repeatedly and returns the latencies in seconds, the
+    upstream calls per request and the peak heap growth in bytes
+    """
+    clear_caches(serve_ical)
+    if not cold:
+        client.get(path).get_data()
+    for stub in stubs:
+        stub.reset_calls()
+
+    latencies = []
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    for _ in range(requests):
+        if cold:
+            clear_caches(serve_ical)
+        started = time.perf_counter()
+        response = client.get(path)
+        response.get_data()
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"{path} returned {response.status_code}")
+    _, peak = tracemalloc.get_traced_memory()
+
+    calls = {}
+    for stub in stubs:
+        for endpoint, count in stub.calls.items():
+            calls[endpoint] = count / requests
+    return latencies, calls, peak - baseline
+
+
+def compare(results, baseline_path: str, tolerance: float):
+    """
+    Returns a list of regressions against the baseline results
+    """
+    with open(baseline_path, "r", encoding="utf-8") as file:
+        baseline = {result["name"]: result for result in json.load(file)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+        if result["upstream_calls"] > previous["upstream_calls"]:
+            regressions.append(
+                f"{result['name']}: upstream calls "
+                f"{previous['upstream_calls']:g} -> {result['upstream_calls']:g}"
+            )
+        allowed = max(previous["p99_ms"] * tolerance, P99_NOISE_MS)
+        if result["p99_ms"] > previous["p99_ms"] + allowed:
+            regressions.append(
+                f"{result['name']}: p99 "
+                f"{previous['p99_ms']:.1f}ms -> {result['p99_ms']:.1f}ms"
+            )
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    windows = [tuple(int(v) for v in w.split(":")) for w in args.windows.split(",")]
+    show_counts = [int(v) for v in args.shows.split(",")]
+    # The app is run from a scratch directory, so resolve paths first
+    json_path = os.path.abspath(args.json) if args.json else None
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+
+    trakt = TraktStub(
+        movies=args.movies, latency=args.latency / 1000, payload_bytes=args.payload
+    ).start()
+    tmdb = TMDBStub(latency=args.latency / 1000, payload_bytes=args.payload).start()
+    workdir = tempfile.mkdtemp(prefix="trakt-ical-bench-")
+    serve_ical = setup_app(workdir, trakt, tmdb)
+    client = serve_ical.app.test_client()
+    tracemalloc.start()
+
+    results = []
+    header = (
+        f"{'scenario':<52} {'p50 ms':>8} {'p99 ms':>8} {'calls':>7} {'peak KiB':>9}"
+    )
+    print(header)
+    print("-" * len(header))
+    for calendar_type in args.types.split(","):
+        for endpoint in args.endpoints.split(","):
+            for days_ago, period in windows:
+                for shows in show_counts:
+                    trakt.shows = shows
+                    path = ENDPOINTS[endpoint].format(
+                        calendar_type=calendar_type,
+                        key=USER_KEY,
+                        days_ago=days_ago,
+                        period=period,
+                    )
+                    for state in ("cold", "warm"):
+                        latencies, calls, peak = run_scenario(
+                            serve_ical,
+                            client,
+                            (trakt, tmdb),
+                            path,
+                            cold=state == "cold",
+                            requests=args.requests,
+                        )
+                        name = (
+                            f"{endpoint}:{calendar_type} window={days_ago}+{period} "
+                            f"shows={shows} {state}"
+                        )
+                        result = {
+                            "name": name,
+                            "p50_ms": percentile(latencies, 50) * 1000,
+                            "p99_ms": percentile(latencies, 99) * 1000,
+                            "upstream_calls": sum(calls.values()),
+                            "upstream": calls,
+                            "peak_bytes": peak,
+                        }
+                        results.append(result)
+                        print(
+                            f"{name:<52} {result['p50_ms']:>8.1f} "
+                            f"{result['p99_ms']:>8.1f} "
+                            f"{result['upstream_calls']:>7g} {peak / 1024:>9.0f}"
+                        )
+
+    trakt.stop()
+    tmdb.stop()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if baseline_path:
+        regressions = compare(results, baseline_path, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
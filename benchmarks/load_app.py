@@ -0,0 +1,38 @@
+"""
+Entry points that load_test.py runs under gunicorn: the real app with its
+users collection swapped for an in-memory one holding LOAD_USERS users, so
+no MongoDB is needed. Every worker seeds the same users and tokens.
+
+    gunicorn load_app:app                                       # Flask
+    gunicorn load_app:create_app -k aiohttp.GunicornWebWorker   # asyncio
+"""
+
+import os
+import sys
+
+from stubs import AsyncMemoryCollection, MemoryCollection, get_user_keys, make_token
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "trakt_ical"))
+
+import serve_ical  # noqa: E402  pylint: disable=wrong-import-position
+from util import encrypt  # noqa: E402  pylint: disable=wrong-import-position
+
+collection = MemoryCollection()
+for key in get_user_keys(int(os.environ.get("LOAD_USERS", "100"))):
+    collection.insert_one(
+        {"user_id": key, "user_slug": key, "token": encrypt(make_token())}
+    )
+serve_ical.get_collection = lambda: collection
+app = serve_ical.app
+
+
+async def create_app():
+    """
+    Returns the asyncio app, reading users from the same collection
+    """
+    import async_api  # pylint: disable=import-outside-toplevel
+    import serve_async  # pylint: disable=import-outside-toplevel
+
+    async_api.get_collection = lambda: AsyncMemoryCollection(collection)
+    return await serve_async.create_app()
@@ -0,0 +1,426 @@
+"""
+Load-tests a running instance of the app with the traffic calendar apps
+generate: every subscribed client polls its feed on a fixed interval, some
+revalidating with the ETag they were given, plus periodic bursts of /json
+previews.
+
+The tool starts local stand-ins for Trakt and TMDB, runs the app under
+gunicorn against them (users come from load_app.py's in-memory collection)
+and replays the mix open-loop, so a slow server can't slow the clients
+down. Every --interval seconds it reports throughput, latency percentiles,
+error rate and upstream amplification (Trakt and TMDB calls per client
+request), then a summary of the whole run.
+
+    python benchmarks/load_test.py --clients 2000 --poll-interval 60 --duration 300
+    python benchmarks/load_test.py --workers 8 --threads 4 --json run.json
+    python benchmarks/load_test.py --worker-class aiohttp --workers 1
+
+The app reads the rest of its settings (cache sizes, ...) from the
+environment as usual, so they can be compared run against run. Its Trakt and
+TMDB rate limits are off unless TRAKT_RATE_LIMIT or TMDB_RATE_LIMIT is set.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import aiohttp
+from cryptography.fernet import Fernet
+
+from bench_feeds import percentile
+
+from stubs import TMDBStub, TraktStub, get_user_keys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = os.path.join(ROOT, "benchmarks")
+TRAKT_ICAL = os.path.join(ROOT, "trakt_ical")
+
+# How long the server gets to start answering.
+STARTUP_TIMEOUT = 60
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--clients", type=int, default=500, help="Subscribed calendar clients"
+    )
+    parser.add_argument(
+        "--users",
+        type=int,
+        default=None,
+        help="Users the clients belong to (default: one per client)",
+    )
+    parser.add_argument(
+        "--feeds",
+        default="shows=3,movies=1,all=1",
+        help="Weights of the feeds the clients subscribe to",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60,
+        help="Seconds between two polls of one client",
+    )
+    parser.add_argument(
+        "--conditional",
+        type=float,
+        default=0.5,
+        help="Share of clients that revalidate with If-None-Match",
+    )
+    parser.add_argument(
+        "--preview-every",
+        type=float,
+        default=30,
+        help="Seconds between bursts of /json previews (0 disables them)",
+    )
+    parser.add_argument(
+        "--preview-burst", type=int, default=20, help="Previews per burst"
+    )
+    parser.add_argument("--duration", type=float, default=120, help="Seconds to run")
+    parser.add_argument(
+        "--interval", type=float, default=10, help="Seconds per report line"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=4, help="Gunicorn worker processes"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Threads per worker; above 1 uses the gthread worker",
+    )
+    parser.add_argument(
+        "--worker-class",
+        choices=("sync", "aiohttp"),
+        default="sync",
+        help="aiohttp serves the asyncio mode from serve_async",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=1000,
+        help="Connections the clients may have open at once",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=60, help="Client request timeout"
+    )
+    parser.add_argument("--shows", type=int, default=20, help="Shows per user")
+    parser.add_argument(
+        "--movies", type=int, default=5, help="Movies released per 30 days"
+    )
+    parser.add_argument(
+        "--latency", type=float, default=50, help="Upstream stub latency in ms"
+    )
+    parser.add_argument(
+        "--payload", type=int, default=0, help="Bytes of padding per upstream item"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--json", help="Write the reports to this file")
+    return parser.parse_args(argv)
+
+
+def parse_weights(value: str):
+    weights = {}
+    for part in value.split(","):
+        name, _, weight = part.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, trakt: TraktStub, tmdb: TMDBStub, workdir: str, port: int):
+    """
+    Starts gunicorn with load_app in workdir, pointed at the stubs
+    """
+    env = dict(os.environ)
+    env.update(
+        {
+            "TRAKT_API_URL": trakt.url,
+            "TRAKT_URL": trakt.url,
+            "TRAKT_CLIENT_ID": "load-test",
+            "TRAKT_CLIENT_SECRET": "load-test",
+            "TMDB_API_URL": f"{tmdb.url}/3",
+            "TMDB_ACCESS_TOKEN": "load-test",
+            "HOST": f"http://127.0.0.1:{port}",
+            "SECRET_KEY": Fernet.generate_key().decode(),
+            "LOAD_USERS": str(args.users or args.clients),
+        }
+    )
+    # The stand-ins have no rate limit to protect, set these to test the app's
+    env.setdefault("TRAKT_RATE_LIMIT", "0")
+    env.setdefault("TMDB_RATE_LIMIT", "0")
+    env.pop("SENTRY_DSN", None)
+    command = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "--config",
+        os.path.join(TRAKT_ICAL, "gunicorn.conf.py"),
+        "--chdir",
+        workdir,
+        "--pythonpath",
+        f"{TRAKT_ICAL},{BENCHMARKS}",
+        "--bind",
+        f"127.0.0.1:{port}",
+        "--workers",
+        str(args.workers),
+        "--timeout",
+        "300",
+        "--log-level",
+        "warning",
+    ]
+    if args.worker_class == "aiohttp":
+        command += [
+            "--worker-class",
+            "aiohttp.GunicornWebWorker",
+            "load_app:create_app",
+        ]
+    elif args.threads > 1:
+        command += ["--worker-class", "gthread", "--threads", str(args.threads)]
+        command.append("load_app:app")
+    else:
+        command.append("load_app:app")
+    return subprocess.Popen(command, env=env)
+
+
+def wait_until_ready(server: subprocess.Popen, url: str):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+        try:
+            with urllib.request.urlopen(f"{url}/", timeout=5):
+                return
+        except urllib.error.HTTPError:
+            return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    raise RuntimeError("gunicorn didn't start in time")
+
+
+def make_schedule(args, rng: random.Random):
+    """
+    Returns the (start time, client) of every request of the run, in order.
+    Clients are dicts holding the path and, for revalidating clients, the
+    last ETag.
+    """
+    feeds = parse_weights(args.feeds)
+    keys = get_user_keys(args.users or args.clients)
+    events = []
+    for index in range(args.clients):
+        client = {
+            "path": (
+                f"/{rng.choices(list(feeds), list(feeds.values()))[0]}"
+                f"?key={keys[index % len(keys)]}"
+            ),
+            "conditional": rng.random() < args.conditional,
+            "etag": None,
+        }
+        # Clients subscribed at random times, so their polls are spread out
+        started = rng.uniform(0, args.poll_interval)
+        events += [
+            (at, client) for at in _frange(started, args.duration, args.poll_interval)
+        ]
+    if args.preview_every > 0:
+        for at in _frange(0, args.duration, args.preview_every):
+            for _ in range(args.preview_burst):
+                calendar_type = rng.choice(list(feeds))
+                path = f"/{calendar_type}/json?key={rng.choice(keys)}"
+                events.append((at, {"path": path}))
+    events.sort(key=lambda event: event[0])
+    return events
+
+
+def _frange(start: float, stop: float, step: float):
+    while start < stop:
+        yield start
+        start += step
+
+
+def get_upstream_calls(stubs):
+    calls = {}
+    for stub in stubs:
+        for endpoint, count in stub.get_calls().items():
+            service = endpoint.split(":", 1)[0]
+            calls[service] = calls.get(service, 0) + count
+    return calls
+
+
+def summarize(results, seconds: float, upstream: dict):
+    """
+    Returns the report of requests finished over seconds, given as
+    (latency, status) pairs, and the upstream calls they caused
+    """
+    latencies = sorted(latency for latency, _ in results)
+    errors = sum(1 for _, status in results if status not in (200, 304))
+    count = len(results)
+    return {
+        "requests": count,
+        "requests_per_second": count / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000 if count else 0.0,
+        "p95_ms": percentile(latencies, 95) * 1000 if count else 0.0,
+        "p99_ms": percentile(latencies, 99) * 1000 if count else 0.0,
+        "max_ms": latencies[-1] * 1000 if count else 0.0,
+        "error_rate": errors / count if count else 0.0,
+        "not_modified": (
+            sum(1 for _, status in results if status == 304) / count if count else 0.0
+        ),
+        "statuses": dict(collections.Counter(str(status) for _, status in results)),
+        "upstream_per_request": {
+            service: calls / count if count else 0.0
+            for service, calls in upstream.items()
+        },
+    }
+
+
+def format_report(label: str, report: dict):
+    upstream = " ".join(
+        f"{service} {value:.2f}"
+        for service, value in sorted(report["upstream_per_request"].items())
+    )
+    return (
+        f"{label:>7} {report['requests_per_second']:>8.1f} "
+        f"{report['p50_ms']:>8.1f} {report['p95_ms']:>8.1f} "
+        f"{report['p99_ms']:>8.1f} {report['max_ms']:>8.1f} "
+        f"{report['error_rate'] * 100:>6.1f}% {report['not_modified'] * 100:>5.1f}%"
+        f"  {upstream or '-'}"
+    )
+
+
+async def run_load(args, url: str, stubs):
+    """
+    Replays the schedule against url and returns the report of every
+    interval and of the whole run
+    """
+    schedule = make_schedule(args, random.Random(args.seed))
+    finished = []
+    pending = set()
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async def fetch(session, client):
+        headers = {"Accept-Encoding": "gzip, br"}
+        if client.get("conditional") and client.get("etag"):
+            headers["If-None-Match"] = client["etag"]
+        request_started = loop.time()
+        try:
+            async with session.get(url + client["path"], headers=headers) as response:
+                await response.read()
+                status = response.status
+                if status == 200 and client.get("conditional"):
+                    client["etag"] = response.headers.get("ETag")
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            status = 0
+        finished.append((loop.time() - started, loop.time() - request_started, status))
+
+    async def send_all(session):
+        for at, client in schedule:
+            delay = started + at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(fetch(session, client))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(set(pending))
+
+    intervals = []
+    header = (
+        f"{'t (s)':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+        f"{'max ms':>8} {'errors':>7} {'304':>6}  upstream calls per request"
+    )
+    print(header)
+    print("-" * len(header))
+    # Calendar apps poll minutes apart, so each poll opens its own connection
+    connector = aiohttp.TCPConnector(limit=args.connections, force_close=True)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        sender = asyncio.create_task(send_all(session))
+        window_start, reported, previous_calls = 0.0, 0, get_upstream_calls(stubs)
+        while True:
+            await asyncio.wait({sender}, timeout=args.interval)
+            now = loop.time() - started
+            calls = get_upstream_calls(stubs)
+            window = [(latency, status) for _, latency, status in finished[reported:]]
+            reported += len(window)
+            report = summarize(
+                window,
+                now - window_start,
+                {
+                    service: count - previous_calls.get(service, 0)
+                    for service, count in calls.items()
+                },
+            )
+            report["t"] = now
+            intervals.append(report)
+            print(format_report(f"{now:.0f}", report), flush=True)
+            window_start, previous_calls = now, calls
+            if sender.done():
+                break
+
+    elapsed = loop.time() - started
+    total = summarize(
+        [(latency, status) for _, latency, status in finished],
+        elapsed,
+        get_upstream_calls(stubs),
+    )
+    print("-" * len(header))
+    print(format_report("total", total))
+    return {"intervals": intervals, "total": total}
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # The app is run from a scratch directory, so resolve paths first
+    json_path = os.path.abspath(args.json) if args.json else None
+    logging.disable(logging.WARNING)
+
+    trakt = TraktStub(
+        shows=args.shows,
+        movies=args.movies,
+        latency=args.latency / 1000,
+        payload_bytes=args.payload,
+    ).start()
+    tmdb = TMDBStub(latency=args.latency / 1000, payload_bytes=args.payload).start()
+    workdir = tempfile.mkdtemp(prefix="trakt-ical-load-")
+    port = get_free_port()
+    server = start_server(args, trakt, tmdb, workdir, port)
+    try:
+        url = f"http://127.0.0.1:{port}"
+        wait_until_ready(server, url)
+        for stub in (trakt, tmdb):
+            stub.reset_calls()
+        result = asyncio.run(run_load(args, url, (trakt, tmdb)))
+    finally:
+        server.terminate()
+        server.wait()
+        trakt.stop()
+        tmdb.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if json_path:
+        result["settings"] = vars(args)
+        with open(json_path, "w", encoding="utf-8") as file:
+            json.dump(result, file, indent=2)
+    return 1 if result["total"]["error_rate"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
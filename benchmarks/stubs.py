@@ -0,0 +1,330 @@
+"""
+Local stand-ins for Trakt, TMDB and MongoDB used by the benchmarks.
+
+The HTTP stubs generate deterministic responses from the request alone, add a
+fixed latency to every call and count calls per endpoint, so benchmark runs
+are repeatable and can report how much upstream traffic each request caused.
+"""
+
+import collections
+import datetime
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class StubServer:
+    """
+    A threaded HTTP server on a free local port. Subclasses implement
+    route(method, path, query, body) returning (status, data).
+
+    Args:
+        latency (float): Seconds added to every response.
+        payload_bytes (int): Padding added to each item's overview, to mimic
+            the size of real responses.
+    """
+
+    def __init__(self, latency: float = 0.0, payload_bytes: int = 0):
+        self.latency = latency
+        self.payload_bytes = payload_bytes
+        self.calls = collections.Counter()
+        self._calls_lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub._handle(self, "GET")
+
+            def do_POST(self):
+                stub._handle(self, "POST")
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_calls(self):
+        with self._calls_lock:
+            self.calls.clear()
+
+    def get_calls(self):
+        """
+        Returns a copy of the call counts, safe to read while serving
+        """
+        with self._calls_lock:
+            return dict(self.calls)
+
+    def count(self, endpoint: str):
+        with self._calls_lock:
+            self.calls[endpoint] += 1
+
+    def padding(self):
+        return "x" * self.payload_bytes
+
+    def route(self, method: str, path: str, query: dict, body: bytes):
+        raise NotImplementedError
+
+    def _handle(self, handler, method):
+        parsed = urlparse(handler.path)
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = handler.rfile.read(length) if length else b""
+        if self.latency:
+            time.sleep(self.latency)
+        status, data = self.route(method, parsed.path, parse_qs(parsed.query), body)
+        payload = json.dumps(data).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(payload)))
+        handler.end_headers()
+        handler.wfile.write(payload)
+
+
+class TraktStub(StubServer):
+    """
+    Serves the Trakt calendar, OAuth token and user settings endpoints.
+
+    Every show airs weekly and every movie is released once per period of
+    movie_interval days, so the number of entries grows with both the window
+    size and the show count.
+    """
+
+    CALENDAR_PATH = re.compile(
+        r"^/calendars/my/(shows|movies)/(\d{4}-\d{2}-\d{2})/(\d+)$"
+    )
+
+    def __init__(
+        self, shows: int = 20, movies: int = 5, movie_interval: int = 30, **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.shows = shows
+        self.movies = movies
+        self.movie_interval = movie_interval
+
+    def route(self, method, path, query, body):
+        match = self.CALENDAR_PATH.match(path)
+        if method == "GET" and match:
+            kind, start, days = match.groups()
+            self.count(f"trakt:calendar:{kind}")
+            start_date = datetime.date.fromisoformat(start)
+            if kind == "shows":
+                return 200, self.episodes(start_date, int(days))
+            return 200, self.releases(start_date, int(days))
+        if method == "POST" and path == "/oauth/token":
+            self.count("trakt:oauth:token")
+            return 200, make_token()
+        if method == "GET" and path == "/users/settings":
+            self.count("trakt:users:settings")
+            return 200, {
+                "user": {"username": "benchmark", "ids": {"slug": "benchmark"}}
+            }
+        self.count("trakt:not_found")
+        return 404, {"error": "not found"}
+
+    def episodes(self, start_date: datetime.date, days: int):
+        items = []
+        for offset in range(days):
+            date = start_date + datetime.timedelta(days=offset)
+            ordinal = date.toordinal()
+            for show in range(self.shows):
+                if (ordinal + show) % 7:
+                    continue
+                airs_at = datetime.datetime.combine(date, datetime.time(hour=show % 24))
+                items.append(
+                    {
+                        "first_aired": airs_at.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                        "episode": {
+                            "season": 1,
+                            "number": ordinal % 100,
+                            "title": f"Episode {ordinal}",
+                            "overview": self.padding(),
+                            "runtime": 45,
+                            "ids": {"trakt": ordinal * 10000 + show},
+                        },
+                        "show": {
+                            "title": f"Show {show}",
+                            "year": 2020,
+                            "overview": self.padding(),
+                            "runtime": 45,
+                            "ids": {
+                                "trakt": show + 1,
+                                "slug": f"show-{show}",
+                                "tmdb": 1000 + show,
+                            },
+                        },
+                    }
+                )
+        return items
+
+    def releases(self, start_date: datetime.date, days: int):
+        items = []
+        for offset in range(days):
+            date = start_date + datetime.timedelta(days=offset)
+            ordinal = date.toordinal()
+            for movie in range(self.movies):
+                if (ordinal + movie) % self.movie_interval:
+                    continue
+                items.append(
+                    {
+                        "released": date.isoformat(),
+                        "movie": {
+                            "title": f"Movie {ordinal}-{movie}",
+                            "year": date.year,
+                            "overview": self.padding(),
+                            "runtime": 110,
+                            "ids": {
+                                "trakt": ordinal * 100 + movie,
+                                "slug": f"movie-{ordinal}-{movie}",
+                                "tmdb": 500000 + ordinal * 100 + movie,
+                            },
+                        },
+                    }
+                )
+        return items
+
+
+class TMDBStub(StubServer):
+    """
+    Serves the TMDB /tv, /movie and /images endpoints under /3
+    """
+
+    PATH = re.compile(r"^/3/(tv|movie)/(\d+)(/images)?$")
+
+    def route(self, method, path, query, body):
+        match = self.PATH.match(path)
+        if method != "GET" or not match:
+            self.count("tmdb:not_found")
+            return 404, {"status_code": 34}
+        kind, tmdb_id, images = match.groups()
+        if images:
+            self.count(f"tmdb:{kind}:images")
+            return 200, self.images(tmdb_id)
+        self.count(f"tmdb:{kind}")
+        data = {
+            "id": int(tmdb_id),
+            "overview": self.padding(),
+            "backdrop_path": f"/{kind}-{tmdb_id}-backdrop.jpg",
+        }
+        if kind == "tv":
+            data["networks"] = [{"id": 49, "name": "HBO"}]
+        if "images" in query.get("append_to_response", [""])[0]:
+            data["images"] = self.images(tmdb_id)
+        return 200, data
+
+    def images(self, tmdb_id):
+        return {
+            "id": int(tmdb_id),
+            "backdrops": [{"file_path": f"/{tmdb_id}-backdrop.jpg"}],
+            "logos": [{"file_path": f"/{tmdb_id}-logo.png"}],
+        }
+
+
+def get_user_keys(count: int):
+    """
+    Returns the keys of the users load_app.py seeds
+    """
+    return [f"loaduser{index:06d}" for index in range(count)]
+
+
+def make_token(expires_in: int = 7776000):
+    """
+    Returns a Trakt OAuth token created now
+    """
+    return {
+        "access_token": "benchmark-access-token",
+        "token_type": "bearer",
+        "expires_in": expires_in,
+        "refresh_token": "benchmark-refresh-token",
+        "scope": "public",
+        "created_at": int(time.time()),
+    }
+
+
+class MemoryCollection:
+    """
+    The subset of a pymongo collection the app uses, kept in memory. Queries
+    only support equality on top-level fields.
+    """
+
+    def __init__(self):
+        self.docs = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _matches(doc: dict, query: dict):
+        return all(doc.get(field) == value for field, value in query.items())
+
+    @staticmethod
+    def _project(doc: dict, projection):
+        if not projection:
+            return dict(doc)
+        return {field: doc[field] for field in projection if field in doc}
+
+    def find_one(self, query: dict, projection=None):
+        with self._lock:
+            for doc in self.docs:
+                if self._matches(doc, query):
+                    return self._project(doc, projection)
+        return None
+
+    def find(self, query: dict = None, projection=None):
+        with self._lock:
+            return [
+                self._project(doc, projection)
+                for doc in self.docs
+                if self._matches(doc, query or {})
+            ]
+
+    def insert_one(self, doc: dict):
+        with self._lock:
+            self.docs.append(dict(doc))
+
+    def update_one(self, query: dict, update: dict, upsert: bool = False):
+        with self._lock:
+            for doc in self.docs:
+                if self._matches(doc, query):
+                    doc.update(update.get("$set", {}))
+                    return
+            if upsert:
+                self.docs.append({**query, **update.get("$set", {})})
+
+    def create_index(self, keys, **kwargs):
+        return keys if isinstance(keys, str) else "_".join(k for k, _ in keys)
+
+    def index_information(self):
+        return {"_id_": {"key": [("_id", 1)]}}
+
+
+class AsyncMemoryCollection:
+    """
+    A MemoryCollection behind the coroutine interface of pymongo's async
+    collections, for the asyncio serving mode
+    """
+
+    def __init__(self, collection: MemoryCollection):
+        self.collection = collection
+
+    async def find_one(self, query: dict, projection=None):
+        return self.collection.find_one(query, projection)
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False):
+        return self.collection.update_one(query, update, upsert)
@@ -0,0 +1,73 @@
+"""
+Tests for escaping and line folding in the iCal writer
+"""
+
+import datetime
+
+import pytest
+
+import ical_writer
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        ("plain", "plain"),
+        ("a;b,c", r"a\;b\,c"),
+        ("back\\slash", r"back\\slash"),
+        ("one\ntwo\r\nthree", r"one\ntwo\nthree"),
+        # Backslashes are escaped first, so escapes aren't doubled
+        (r"\;", r"\\\;"),
+    ],
+)
+def test_escape_text(value, expected):
+    assert ical_writer.escape_text(value) == expected
+
+
+def unfold(folded: str):
+    assert folded.endswith("\r\n")
+    return folded[:-2].replace("\r\n ", "")
+
+
+def test_short_line_is_not_folded():
+    line = "SUMMARY:" + "x" * 67
+    assert len(line) == ical_writer.MAX_LINE_OCTETS
+    assert ical_writer.fold(line) == line + "\r\n"
+
+
+@pytest.mark.parametrize("text", ["x" * 200, "é" * 100, "a" + "日本語" * 40, "🎬" * 50])
+def test_fold_limits_octets_and_keeps_characters(text):
+    line = f"DESCRIPTION:{text}"
+    folded = ical_writer.fold(line)
+    physical = folded[:-2].split("\r\n")
+    assert len(physical) > 1
+    for part in physical:
+        assert len(part.encode("utf-8")) <= ical_writer.MAX_LINE_OCTETS
+    assert all(part.startswith(" ") for part in physical[1:])
+    assert unfold(folded) == line
+
+
+def test_render_properties_orders_and_skips_empty_values():
+    event = {
+        "uid": "1",
+        "x-custom": "last",
+        "summary": "Pilot, part 1",
+        "description": "",
+        "location": None,
+        "dtstart": datetime.datetime(2026, 1, 2, 20, 30),
+        "dtstamp": datetime.datetime(2026, 1, 1, 12),
+    }
+    assert ical_writer.render_properties(event, ical_writer.EVENT_ORDER) == (
+        "SUMMARY:Pilot\\, part 1\r\n"
+        "DTSTART:20260102T203000\r\n"
+        "DTSTAMP:20260101T120000Z\r\n"
+        "UID:1\r\n"
+        "X-CUSTOM:last\r\n"
+    )
+
+
+def test_format_value_converts_aware_datetimes_to_utc():
+    tz = datetime.timezone(datetime.timedelta(hours=2))
+    value = datetime.datetime(2026, 1, 2, 20, 30, tzinfo=tz)
+    assert ical_writer.format_value("dtstart", value) == "20260102T183000Z"
+    assert ical_writer.format_value("dtstart", value.date()) == "20260102"
@@ -0,0 +1,141 @@
+"""
+Tests for the cursor and limit arguments of paged previews
+"""
+
+import datetime
+
+import pytest
+from flask_caching import Cache
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+import serve_ical
+from calendar_entry import CalendarEntry
+
+
+@pytest.fixture(name="client")
+def fixture_client():
+    return serve_ical.app.test_client()
+
+
+@pytest.fixture(name="feed_cache")
+def fixture_feed_cache(monkeypatch, tmp_path):
+    feed_cache = Cache()
+    feed_cache.init_app(
+        serve_ical.app,
+        config={
+            **serve_ical.app.config,
+            "CACHE_SQLITE_PATH": str(tmp_path / "feeds.sqlite3"),
+        },
+    )
+    monkeypatch.setattr(serve_ical, "get_cache", lambda: feed_cache)
+    return feed_cache
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        {"limit": "0"},
+        {"limit": "-1"},
+        {"limit": "ten"},
+        {"limit": "1.5"},
+        {"cursor": "soon"},
+        {"cursor": "nan"},
+        {"cursor": "inf"},
+    ],
+)
+def test_get_page_rejects_invalid_arguments(args):
+    with pytest.raises(ValueError):
+        serve_ical.get_page(args)
+
+
+def test_get_page_parses_valid_arguments():
+    assert serve_ical.get_page({"limit": "7", "cursor": "1700000000"}) == (
+        1700000000.0,
+        7,
+    )
+    assert serve_ical.get_page({}) == (None, None)
+
+
+@pytest.mark.parametrize(
+    "query, error",
+    [
+        ("limit=0", "limit must be at least 1"),
+        ("limit=-1", "limit must be at least 1"),
+        ("limit=ten", "limit must be an integer"),
+        ("cursor=soon", "cursor must be a number"),
+    ],
+)
+def test_preview_rejects_invalid_page(client, monkeypatch, query, error):
+    # Validation happens before the user is looked up
+    monkeypatch.setattr(serve_ical, "get_token", pytest.fail)
+    response = client.get(f"/shows/json?key=abc&{query}")
+    assert response.status_code == 400
+    assert response.get_json() == {"error": error}
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        ("*/*", False),
+        ("application/json", False),
+        ("application/json, application/x-ndjson;q=0.5", False),
+        ("application/x-ndjson", True),
+        ("application/x-ndjson, */*;q=0.1", True),
+    ],
+)
+def test_wants_ndjson(accept, expected):
+    assert serve_ical.wants_ndjson(parse_accept_header(accept, MIMEAccept)) is expected
+
+
+def test_preview_for_any_type_is_served_from_cache(client, monkeypatch, feed_cache):
+    cache_key = serve_ical.get_feed_key("get_calendar_preview", "abc", "shows", 30, 90)
+    feed = serve_ical.store_feed(cache_key, '{"type": "shows", "data": []}')
+    monkeypatch.setattr(serve_ical, "preview_page_response", pytest.fail)
+
+    response = client.get("/shows/json?key=abc", headers={"Accept": "*/*"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == f'"{feed["etag"]}"'
+
+    response = client.get(
+        "/shows/json?key=abc",
+        headers={"Accept": "*/*", "If-None-Match": response.headers["ETag"]},
+    )
+    assert response.status_code == 304
+
+
+def make_entry(day: int):
+    starts_at = datetime.datetime(2026, 1, day, 20, tzinfo=datetime.timezone.utc)
+    return CalendarEntry("movies", starts_at, f"Movie {day}", None, None, {}, day, day)
+
+
+def test_ndjson_preview_streams_each_day_once_enriched(client, monkeypatch):
+    enriched = []
+
+    def enrich_preview_entries(calendar_type, entries, fields=None):
+        enriched.append([entry.title for entry in entries])
+        return [{"title": entry.title} for entry in entries]
+
+    monkeypatch.setattr(serve_ical, "get_token", lambda key: {"access_token": "t"})
+    monkeypatch.setattr(
+        serve_ical,
+        "get_preview_entries",
+        lambda *args: [make_entry(day) for day in (1, 2, 3)],
+    )
+    monkeypatch.setattr(serve_ical, "enrich_preview_entries", enrich_preview_entries)
+
+    response = client.get("/movies/json?key=abc&format=ndjson", buffered=False)
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.iter_encoded()
+    first = serve_ical.app.json.loads(next(lines))
+    # Only the first day has been enriched when its line is sent
+    assert first["items"] == [{"title": "Movie 1"}]
+    assert enriched == [["Movie 1"]]
+
+    rest = [serve_ical.app.json.loads(line) for line in lines]
+    assert [day["items"] for day in rest] == [
+        [{"title": "Movie 2"}],
+        [{"title": "Movie 3"}],
+    ]
+    assert enriched == [["Movie 1"], ["Movie 2"], ["Movie 3"]]
+    response.close()
@@ -0,0 +1,104 @@
+"""
+Tests for the shared token bucket and its lanes
+"""
+
+import concurrent.futures
+
+import pytest
+
+import rate_limit
+
+
+class Clock:
+    """
+    Stands in for the time module, advancing only when slept on
+    """
+
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture(name="clock")
+def fixture_clock(monkeypatch, tmp_path):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, "time", clock)
+    monkeypatch.setattr(rate_limit, "LOCK_DIR", str(tmp_path))
+    monkeypatch.setattr(rate_limit, "BACKGROUND_RESERVE", 0.25)
+    return clock
+
+
+def test_bucket_starts_full_and_refills_at_rate(clock):
+    limiter = rate_limit.RateLimiter("test", rate=10, burst=4)
+    assert [limiter._take(0) for _ in range(4)] == [0, 0, 0, 0]
+    assert limiter._take(0) == pytest.approx(0.1)
+
+    clock.sleep(0.25)
+    assert limiter._take(0) == 0
+    assert limiter._take(0) == 0
+    assert limiter._take(0) == pytest.approx(0.05)
+
+
+def test_refill_is_capped_at_burst(clock):
+    limiter = rate_limit.RateLimiter("test", rate=10, burst=4)
+    limiter._take(0)
+    clock.sleep(3600)
+    assert [limiter._take(0) for _ in range(4)] == [0, 0, 0, 0]
+    assert limiter._take(0) > 0
+
+
+def test_state_is_shared_through_the_file(clock):
+    first = rate_limit.RateLimiter("test", rate=10, burst=2)
+    second = rate_limit.RateLimiter("test", rate=10, burst=2)
+    assert first._take(0) == 0
+    assert second._take(0) == 0
+    assert first._take(0) > 0
+
+
+def test_background_lane_leaves_reserve_for_interactive(clock):
+    limiter = rate_limit.RateLimiter("test", rate=10, burst=4)
+    for _ in range(3):
+        assert limiter._poll(rate_limit.BACKGROUND, clock.monotonic()) == 0
+    # One token is left, but it's kept for interactive requests
+    assert limiter._poll(rate_limit.BACKGROUND, clock.monotonic()) > 0
+    assert limiter._poll(rate_limit.INTERACTIVE, clock.monotonic()) == 0
+
+
+def test_lane_defaults_and_is_bound_into_threads(clock):
+    assert rate_limit.get_lane() == rate_limit.default_lane
+    with rate_limit.lane(rate_limit.BACKGROUND):
+        unbound = rate_limit.get_lane
+        bound = rate_limit.bind(rate_limit.get_lane)
+    with concurrent.futures.ThreadPoolExecutor(1) as pool:
+        assert pool.submit(unbound).result() == rate_limit.default_lane
+        assert pool.submit(bound).result() == rate_limit.BACKGROUND
+    assert rate_limit.get_lane() == rate_limit.default_lane
+
+
+def test_acquire_waits_for_a_token(clock):
+    limiter = rate_limit.RateLimiter("test", rate=2, burst=1)
+    limiter.acquire()
+    started = clock.now
+    limiter.acquire()
+    assert clock.now - started >= 0.5
+
+
+def test_pause_beyond_max_wait_raises(clock, monkeypatch):
+    monkeypatch.setattr(rate_limit, "MAX_WAIT", 30)
+    limiter = rate_limit.RateLimiter("test", rate=0, burst=1)
+    # A rate of 0 turns the bucket off
+    for _ in range(5):
+        limiter.acquire()
+    limiter.pause(60)
+    with pytest.raises(rate_limit.RateLimited):
+        limiter.acquire()
+    clock.sleep(60)
+    limiter.acquire()
@@ -0,0 +1,95 @@
+"""
+Tests for single-flight locks
+"""
+
+import fcntl
+import os
+import threading
+
+import pytest
+
+import serve_ical
+import single_flight
+from single_flight import SingleFlight
+
+
+@pytest.fixture(autouse=True)
+def fixture_lock_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(single_flight, "LOCK_DIR", str(tmp_path))
+
+
+def test_lock_is_exclusive_until_released():
+    leader = SingleFlight("feed")
+    assert leader.acquire()
+    assert not SingleFlight("feed").acquire(timeout=0)
+    other = SingleFlight("other")
+    assert other.acquire(timeout=0)
+    other.release()
+
+    leader.release()
+    # Releasing twice is a no-op
+    leader.release()
+    follower = SingleFlight("feed")
+    assert follower.acquire(timeout=0)
+    follower.release()
+
+
+def test_registry_is_emptied_after_release():
+    with SingleFlight("feed"):
+        assert "feed" in single_flight._thread_locks
+        assert not SingleFlight("feed").acquire(timeout=0)
+    assert "feed" not in single_flight._thread_locks
+
+
+def test_context_manager_releases_on_error():
+    with pytest.raises(RuntimeError):
+        with SingleFlight("feed"):
+            raise RuntimeError
+    assert "feed" not in single_flight._thread_locks
+
+
+def test_waiter_gets_the_lock_when_leader_releases():
+    events = []
+    waiting = threading.Event()
+
+    def wait():
+        waiting.set()
+        with SingleFlight("feed"):
+            events.append("waiter")
+
+    with SingleFlight("feed"):
+        thread = threading.Thread(target=wait)
+        thread.start()
+        waiting.wait()
+        thread.join(0.2)
+        # The waiter is still blocked while the leader holds the lock
+        assert thread.is_alive()
+        events.append("leader")
+    thread.join(5)
+    assert not thread.is_alive()
+    assert events == ["leader", "waiter"]
+
+
+def test_lock_held_by_another_process_times_out(monkeypatch):
+    monkeypatch.setattr(single_flight, "POLL_INTERVAL", 0.01)
+    lock = SingleFlight("feed")
+    os.makedirs(single_flight.LOCK_DIR, exist_ok=True)
+    # Another process holding the flock looks the same as another descriptor
+    fd = os.open(lock.path, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    try:
+        assert not lock.acquire(timeout=0.05)
+        # The thread lock was handed back on the way out
+        assert "feed" not in single_flight._thread_locks
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+    assert lock.acquire(timeout=0)
+    lock.release()
+
+
+def test_flight_names_are_per_cache_prefix():
+    args = ("abc", "shows", 30, 90)
+    assert serve_ical.get_flight_name(
+        "calendar_ical", *args
+    ) != serve_ical.get_flight_name("get_calendar_preview", *args)
@@ -0,0 +1,58 @@
+"""
+Tests for reading entries from the feed cache
+"""
+
+import pickle
+
+import pytest
+
+import tiered_cache
+
+CORRUPT_BLOBS = [
+    b"not a pickle",
+    pickle.dumps({"body": "feed"})[:-3],
+    # A class from a module that no longer exists
+    b"\x80\x04\x8c\x08nomodule\x94\x8c\x03Foo\x94\x93\x94.",
+]
+
+
+@pytest.fixture(name="cache")
+def fixture_cache(tmp_path):
+    return tiered_cache.TieredCache(str(tmp_path / "feeds.sqlite3"))
+
+
+@pytest.mark.parametrize("blob", CORRUPT_BLOBS)
+def test_corrupt_entry_is_a_miss_and_removed(cache, blob):
+    cache.disk.set_blob("feed", blob, 60)
+    assert cache.get("feed") is None
+    assert cache.disk.get_blob("feed") is None
+
+
+@pytest.mark.parametrize("blob", CORRUPT_BLOBS)
+def test_sqlite_cache_removes_corrupt_entry(cache, blob):
+    cache.disk.set_blob("feed", blob, 60)
+    assert cache.disk.get("feed") is None
+    assert cache.disk.get_blob("feed") is None
+
+
+def test_valid_entry_is_read_from_disk(cache):
+    cache.set("feed", {"body": "feed"})
+    cache.memory.clear()
+    assert cache.get("feed") == {"body": "feed"}
+
+
+def test_default_for_missing_key_is_remembered_in_memory(cache, monkeypatch):
+    assert cache.get_or_default("generation:abc", 0) == 0
+    monkeypatch.setattr(cache.disk, "get_blob", pytest.fail)
+    assert cache.get_or_default("generation:abc", 0) == 0
+    assert cache.get_stats()["memory_entries"] == 1
+    assert "miss" not in cache.get_stats()
+
+
+def test_default_gives_way_to_stored_value(cache):
+    assert cache.get_or_default("generation:abc", 0) == 0
+    cache.set("generation:abc", 5, timeout=0)
+    assert cache.get_or_default("generation:abc", 0) == 5
+    cache.memory.clear()
+    assert cache.get_or_default("generation:abc", 0) == 5
+    assert "disk_hit" not in cache.get_stats()
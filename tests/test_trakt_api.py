@@ -0,0 +1,82 @@
+"""
+Tests for the calendar windows of the Trakt client and their 30-day buckets
+"""
+
+import datetime
+
+import pytest
+
+import trakt_api
+from calendar_entry import CalendarEntry
+
+
+def make_entry(day: datetime.date):
+    starts_at = datetime.datetime.combine(day, datetime.time(20))
+    return CalendarEntry("movies", starts_at, day.isoformat(), None, None, {}, 1, 1)
+
+
+@pytest.fixture(name="windows")
+def fixture_windows(monkeypatch):
+    windows = []
+
+    def get_windows(self, kinds, days_ago, period):
+        windows.append((days_ago, period))
+        return {kind: [] for kind in kinds}
+
+    monkeypatch.setattr(trakt_api.TraktAPI, "_get_windows", get_windows)
+    return windows
+
+
+@pytest.mark.parametrize(
+    "method", ["iter_shows_calendar", "iter_movies_calendar", "iter_all_calendar"]
+)
+def test_iter_calendar_keeps_zero_window(windows, method):
+    "".join(getattr(trakt_api.TraktAPI(), method)(days_ago=0, period=0))
+    assert windows == [(0, 0)]
+
+
+def test_buckets_are_aligned_and_cover_the_window():
+    start = datetime.date(2026, 3, 10)
+    buckets = trakt_api.get_buckets(start, start + datetime.timedelta(days=90))
+    assert buckets[0] <= start < buckets[1]
+    assert all(bucket.toordinal() % trakt_api.BUCKET_DAYS == 0 for bucket in buckets)
+    assert all(
+        later - earlier == datetime.timedelta(days=trakt_api.BUCKET_DAYS)
+        for earlier, later in zip(buckets, buckets[1:])
+    )
+    last_day = start + datetime.timedelta(days=89)
+    assert buckets[-1] <= last_day < buckets[-1] + datetime.timedelta(days=30)
+
+
+def test_bucket_end_is_exclusive():
+    bucket = datetime.date.fromordinal(trakt_api.BUCKET_DAYS * 24000)
+    next_bucket = bucket + datetime.timedelta(days=trakt_api.BUCKET_DAYS)
+    assert trakt_api.get_buckets(bucket, next_bucket) == [bucket]
+    assert trakt_api.get_buckets(bucket, next_bucket + datetime.timedelta(days=1)) == [
+        bucket,
+        next_bucket,
+    ]
+
+
+def test_zero_days_ago_starts_today():
+    today, start, end = trakt_api.TraktAPI._get_range(0, 0)
+    assert start == end == today
+
+
+def test_window_is_trimmed_from_its_buckets(monkeypatch):
+    fetched = []
+
+    def fetch_calendar(self, kind, bucket_start):
+        fetched.append(bucket_start)
+        return [
+            make_entry(bucket_start + datetime.timedelta(days=day))
+            for day in range(trakt_api.BUCKET_DAYS)
+        ]
+
+    monkeypatch.setattr(trakt_api.TraktAPI, "_fetch_calendar", fetch_calendar)
+    entries = trakt_api.TraktAPI().get_movies_batch(days_ago=0, period=7)
+    today = datetime.datetime.now().date()
+    assert fetched == trakt_api.get_buckets(today, today + datetime.timedelta(days=7))
+    assert [entry.starts_at.date() for entry in entries] == [
+        today + datetime.timedelta(days=day) for day in range(7)
+    ]
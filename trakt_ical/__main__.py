@@ -1,6 +1,7 @@
 import argparse
-from serve_ical import serve
-
+import time
+from serve_ical import purge_user, serve
+from prerender import DEFAULT_TYPES, prerender
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -8,9 +9,78 @@ if __name__ == "__main__":
     parser.add_argument("--host", help="Host to serve the ical file", default="0.0.0.0")
     parser.add_argument("--port", help="Port to serve the ical file", default=8000)
     parser.add_argument("--debug", help="Debug mode", default=False)
+    parser.add_argument(
+        "--async",
+        help="Serve the feeds from an asyncio event loop (needs aiohttp)",
+        action="store_true",
+        dest="use_async",
+    )
+    parser.add_argument(
+        "--purge-user",
+        help="Drop every cached feed of the user with this key",
+        metavar="KEY",
+    )
+    parser.add_argument(
+        "--prerender",
+        help="Build every user's feeds into the serving cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--types",
+        help="Comma separated calendar types to pre-render",
+        default=",".join(DEFAULT_TYPES),
+    )
+    parser.add_argument(
+        "--processes", help="Processes used to pre-render", type=int, default=None
+    )
+    parser.add_argument(
+        "--max-connections",
+        help="Upstream requests each pre-render process may run at once",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--export",
+        help="Pre-render every user's feeds as static files into this directory",
+        metavar="DIR",
+    )
+    parser.add_argument(
+        "--interval",
+        help="Repeat --prerender or --export every this many seconds",
+        type=int,
+        default=0,
+    )
 
     args = parser.parse_args()
 
-    if args.serve:
+    if args.purge_user:
+        purge_user(args.purge_user)
+        print(f"Purged the cached feeds of {args.purge_user}")
+
+    while args.prerender or args.export:
+        report = prerender(
+            args.types.split(","), args.processes, args.max_connections, args.export
+        )
+        calls = ", ".join(
+            f"{service} {count:.1f}"
+            for service, count in sorted(report["calls_per_user"].items())
+        )
+        print(
+            f"Pre-rendered {report['rendered']} feeds for {report['users']} users "
+            f"({report['changed']} changed, {report['failed']} failed) "
+            f"in {report['seconds']:.1f}s: "
+            f"{report['users_per_second']:.2f} users/s, "
+            f"upstream calls per user: {calls or 'none'}"
+        )
+        if not args.interval:
+            break
+        time.sleep(max(0, args.interval - report["seconds"]))
+
+    if args.serve and args.use_async:
+        from serve_async import serve as serve_async
+
+        print("Serving the ical file from an event loop")
+        serve_async(args.host, args.port)
+    elif args.serve:
         print("Serving the ical file")
         serve(args.host, args.port, args.debug)
@@ -0,0 +1,228 @@
+"""
+Asyncio counterparts of the Trakt, TMDB and MongoDB clients, for serve_async.
+
+They share their caches, rate limits, parsing and rendering with the
+synchronous clients and only replace the I/O, so a single event loop can
+wait on hundreds of upstream requests at once. The SQLite caches and the
+rate limiter's file lock are still used synchronously, on threads, so a busy
+lock never stalls the loop. Needs aiohttp; pymongo ships its
+AsyncMongoClient itself (from 4.9).
+"""
+
+import asyncio
+import logging
+import os
+
+import aiohttp
+import pymongo
+import requests
+
+import metrics
+import rate_limit
+import timing
+import tmdb_api
+import trakt_api
+from tmdb_api import TMDB, MAX_CONCURRENCY
+from trakt_api import TraktAPI
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on open upstream connections per process.
+MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "100"))
+
+TIMEOUT = aiohttp.ClientTimeout(total=10)
+
+# Errors a failed upstream request raises
+ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, rate_limit.RateLimited)
+
+_session = None
+_mongo_client = None
+_tmdb_semaphore = None
+
+
+def get_session():
+    """
+    Returns the keep-alive session used for every upstream request in this
+    process. Must be called from the event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONNECTIONS),
+            timeout=TIMEOUT,
+        )
+    return _session
+
+
+def get_collection():
+    """
+    Returns the users collection through this process's AsyncMongoClient
+    """
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = pymongo.AsyncMongoClient(
+            os.environ.get("MONGO_URL"),
+            event_listeners=metrics.get_event_listeners(),
+        )
+    return _mongo_client.trakt_ical.users
+
+
+async def close():
+    """
+    Closes the HTTP session and the Mongo client
+    """
+    global _session, _mongo_client
+    if _session is not None:
+        await _session.close()
+        _session = None
+    if _mongo_client is not None:
+        await _mongo_client.close()
+        _mongo_client = None
+
+
+async def send(service: str, method: str, url: str, endpoint: str, **kwargs):
+    """
+    rate_limit.send for aiohttp. The returned response has been read, so its
+    json() can be awaited after the connection went back to the pool.
+    """
+    limiter = rate_limit.get_limiter(service)
+    for attempt in range(rate_limit.MAX_RETRIES + 1):
+        await limiter.acquire_async()
+        with metrics.track_upstream(service, endpoint) as result:
+            async with get_session().request(method, url, **kwargs) as response:
+                result["status"] = response.status
+                await response.read()
+        retry_after = rate_limit.get_retry_after(response)
+        if retry_after:
+            await asyncio.to_thread(limiter.pause, retry_after)
+        if response.status not in rate_limit.RETRY_STATUSES:
+            return response
+        delay = rate_limit.get_retry_delay(attempt, retry_after)
+        if delay is None:
+            break
+        await asyncio.sleep(delay)
+    if response.status == 429:
+        raise rate_limit.RateLimited(service, retry_after or 0)
+    return response
+
+
+class AsyncTMDB(TMDB):
+    """
+    TMDB client whose lookups are coroutines
+    """
+
+    async def get_many(self, fetch, ids):
+        """
+        Awaits fetch once per distinct, non-empty id in ids, at most
+        MAX_CONCURRENCY at a time in this process. Returns a dict mapping
+        each id to its result, or to an empty dict if the lookup failed.
+        """
+        global _tmdb_semaphore
+        if _tmdb_semaphore is None:
+            _tmdb_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        unique_ids = list(dict.fromkeys(i for i in ids if i))
+
+        async def run(tmdb_id):
+            async with _tmdb_semaphore:
+                try:
+                    return await fetch(tmdb_id)
+                except ERRORS + (requests.RequestException, ValueError) as error:
+                    logger.warning(
+                        {
+                            "message": "TMDB lookup failed",
+                            "info": {"id": tmdb_id, "error": error},
+                        }
+                    )
+                    tmdb_api.record_failure(tmdb_id)
+                    return {}
+
+        with timing.phase("tmdb"):
+            results = await asyncio.gather(*(run(i) for i in unique_ids))
+        return dict(zip(unique_ids, results))
+
+    async def _get_cached_async(self, endpoint: str, url: str, params=None, trim=None):
+        key = self._cache_key(url, params)
+        data = await asyncio.to_thread(self.cache.get, key)
+        if data is not None:
+            return data
+        response = await send(
+            "tmdb", "GET", url, endpoint, headers=self.headers, params=params
+        )
+        data = await response.json(content_type=None)
+        return await asyncio.to_thread(
+            self._store, endpoint, key, response.status, data, trim
+        )
+
+    async def get_show_summary(self, show_id: int):
+        return await self._get_cached_async(
+            "tv_summary",
+            f"{self.base_url}/tv/{show_id}",
+            self._summary_params(),
+            self._trim_summary,
+        )
+
+    async def get_movie_summary(self, movie_id: int):
+        return await self._get_cached_async(
+            "movie_summary",
+            f"{self.base_url}/movie/{movie_id}",
+            self._summary_params(),
+            self._trim_summary,
+        )
+
+
+class AsyncTraktAPI(TraktAPI):
+    """
+    Trakt client whose calendar fetches are coroutines
+    """
+
+    def __init__(self, oauth_token=None, user_id: str = None, generation: int = 0):
+        super().__init__(oauth_token, user_id, generation)
+        self.tmdb = AsyncTMDB()
+
+    async def get_windows(self, kinds, days_ago: int, period: int):
+        """
+        Returns a dict mapping each kind to its calendar items dated from
+        days_ago days ago up to period days from now, fetching the missing
+        buckets all at once
+        """
+        today, start, end = self._get_range(days_ago, period)
+        buckets = trakt_api.get_buckets(start, end)
+        with timing.phase("trakt"):
+            results, missing = await asyncio.to_thread(
+                self._read_buckets, kinds, buckets
+            )
+            fetched = await asyncio.gather(
+                *(self._fetch_calendar_async(kind, bucket) for kind, bucket in missing)
+            )
+        for (kind, bucket_start), items in zip(missing, fetched):
+            results[kind, bucket_start] = items
+            await asyncio.to_thread(
+                self._store_bucket, kind, bucket_start, items, today
+            )
+        windows = self._join_buckets(kinds, buckets, results)
+        return self._trim_windows(windows, start, end)
+
+    async def _fetch_calendar_async(self, kind: str, start_date):
+        response = await send(
+            "trakt",
+            "GET",
+            trakt_api.get_calendar_url(kind, start_date),
+            f"calendar_{kind}",
+            headers=self.headers,
+            params={"extended": "full"},
+        )
+        response.raise_for_status()
+        return trakt_api.parse_calendar(kind, await response.json(content_type=None))
+
+    async def get_calendar(self, calendar_type: str, days_ago: int, period: int):
+        """
+        Returns the shows, movies or all calendar in iCal format
+        """
+        kinds = ["shows", "movies"] if calendar_type == "all" else [calendar_type]
+        windows = await self.get_windows(kinds, days_ago, period)
+        episodes = windows.get("shows", [])
+        summaries = await self.tmdb.get_many(
+            self.tmdb.get_show_summary, [episode.tmdb_id for episode in episodes]
+        )
+        with timing.phase("render"):
+            return "".join(self.render(episodes, windows.get("movies", []), summaries))
@@ -0,0 +1,77 @@
+"""
+Compact, normalized calendar entries shared by the iCal and JSON paths.
+
+pytrakt objects carry every field Trakt returns plus lazy-loading machinery.
+They are turned into CalendarEntry tuples as soon as a calendar bucket is
+fetched, so only these small records are cached and kept alive per request.
+"""
+
+import datetime
+from typing import NamedTuple, Optional
+
+
+class CalendarEntry(NamedTuple):
+    """
+    One episode airing or movie release.
+
+    For episodes, ids, tmdb_id and runtime fall back to those of the show,
+    while trakt_id is the episode's own id.
+    """
+
+    kind: str
+    starts_at: datetime.datetime
+    title: str
+    overview: Optional[str]
+    runtime: Optional[int]
+    ids: dict
+    tmdb_id: Optional[int]
+    trakt_id: Optional[int]
+    show: Optional[str] = None
+    season: Optional[int] = None
+    number: Optional[int] = None
+
+    @property
+    def released(self):
+        """
+        The release date of a movie as an ISO string
+        """
+        return self.starts_at.date().isoformat()
+
+    @classmethod
+    def from_episode(cls, episode):
+        """
+        Normalizes a pytrakt TVEpisode from a calendar
+        """
+        show_data = episode.show_data
+        show_ids = show_data.__dict__.get("_ids") or {}
+        episode_ids = episode.__dict__.get("_ids") or {}
+        return cls(
+            kind="shows",
+            starts_at=episode.airs_at,
+            title=episode.title,
+            overview=episode.overview,
+            runtime=episode.runtime or getattr(show_data, "runtime", None) or None,
+            ids=show_ids,
+            tmdb_id=show_ids.get("tmdb"),
+            trakt_id=episode_ids.get("trakt"),
+            show=episode.show,
+            season=episode.season,
+            number=episode.number,
+        )
+
+    @classmethod
+    def from_movie(cls, movie):
+        """
+        Normalizes a pytrakt Movie from a calendar
+        """
+        movie_ids = movie.__dict__.get("_ids") or {}
+        return cls(
+            kind="movies",
+            starts_at=datetime.datetime.strptime(movie.released, "%Y-%m-%d"),
+            title=movie.title,
+            overview=movie.overview,
+            runtime=getattr(movie, "runtime", None),
+            ids=movie_ids,
+            tmdb_id=movie_ids.get("tmdb"),
+            trakt_id=movie_ids.get("trakt"),
+        )
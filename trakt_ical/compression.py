@@ -0,0 +1,54 @@
+"""
+Pre-compressed variants of cached bodies.
+
+Feeds are compressed once when they are cached and the stored variant is
+picked per request from Accept-Encoding, so polls never compress anything.
+Brotli is used when the brotli package is installed, gzip always.
+"""
+
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression only runs once per build, so favour size over speed, but stay
+# below brotli's slowest levels, which take seconds on large feeds.
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+# Bodies smaller than this aren't worth a variant.
+MIN_SIZE = 1024
+
+
+def get_encodings():
+    """
+    Returns the supported content codings, most preferred first
+    """
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def compress_variants(body: bytes):
+    """
+    Returns a dict mapping each supported content coding to body compressed
+    with it, or an empty dict if body is too small to bother
+    """
+    if len(body) < MIN_SIZE:
+        return {}
+    variants = {"gzip": gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        variants["br"] = brotli.compress(body, quality=BROTLI_QUALITY)
+    return variants
+
+
+def choose_encoding(accept_encodings, variants: dict):
+    """
+    Returns the content coding of the variant to send for a request's
+    Accept-Encoding header, or None for the raw body
+    """
+    available = [encoding for encoding in get_encodings() if encoding in variants]
+    if not available:
+        return None
+    encoding = accept_encodings.best_match(available + ["identity"])
+    return encoding if encoding in variants else None
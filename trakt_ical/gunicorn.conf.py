@@ -0,0 +1,34 @@
+"""
+Gunicorn settings, picked up automatically when gunicorn is started from this
+directory.
+
+With METRICS_ENABLED set, the workers write their metrics to a shared
+directory so /metrics reports the whole server, not just the worker that
+answered the scrape.
+"""
+
+import os
+import shutil
+
+if os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes"):
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "./cache/metrics")
+
+
+def on_starting(server):
+    """
+    Clears the samples left behind by a previous run
+    """
+    path = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if path:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """
+    Drops the live gauges of a worker that exited
+    """
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,111 @@
+"""
+Minimal streaming iCalendar (RFC 5545) writer.
+
+Only covers what the feeds need: text and date-time properties on VEVENTs.
+Output is produced one event at a time so a feed never has to be held in
+memory as an object graph.
+"""
+
+import datetime
+
+# Properties are written in the same order icalendar uses, so feeds produced
+# by this module look like the ones clients have already imported.
+CALENDAR_ORDER = ("version", "prodid")
+EVENT_ORDER = (
+    "summary",
+    "dtstart",
+    "dtend",
+    "dtstamp",
+    "uid",
+    "description",
+    "location",
+)
+
+# Content lines are folded at 75 octets, excluding the line break.
+MAX_LINE_OCTETS = 75
+
+
+def escape_text(value: str):
+    """
+    Escapes a TEXT value
+    """
+    return (
+        value.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+
+def format_value(name: str, value):
+    """
+    Formats a property value. Naive datetimes are written as floating times,
+    except DTSTAMP which must be in UTC.
+    """
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+            return value.strftime("%Y%m%dT%H%M%SZ")
+        if name == "dtstamp":
+            return value.strftime("%Y%m%dT%H%M%SZ")
+        return value.strftime("%Y%m%dT%H%M%S")
+    if isinstance(value, datetime.date):
+        return value.strftime("%Y%m%d")
+    return escape_text(str(value))
+
+
+def fold(line: str):
+    """
+    Folds a content line into chunks of at most 75 octets, never splitting a
+    UTF-8 sequence, and terminates it with CRLF
+    """
+    encoded = line.encode("utf-8")
+    if len(encoded) <= MAX_LINE_OCTETS:
+        return line + "\r\n"
+    parts = []
+    start = 0
+    limit = MAX_LINE_OCTETS
+    while start < len(encoded):
+        end = min(start + limit, len(encoded))
+        # Back off to the start of a UTF-8 sequence
+        while end < len(encoded) and (encoded[end] & 0xC0) == 0x80:
+            end -= 1
+        parts.append(encoded[start:end].decode("utf-8"))
+        start = end
+        # Continuation lines spend one octet on the leading space
+        limit = MAX_LINE_OCTETS - 1
+    return "\r\n ".join(parts) + "\r\n"
+
+
+def render_properties(properties: dict, order):
+    """
+    Returns the content lines for properties, known names first in order
+    """
+    names = [name for name in order if name in properties]
+    names += sorted(name for name in properties if name not in order)
+    lines = []
+    for name in names:
+        value = properties[name]
+        if value is None or value == "":
+            continue
+        lines.append(fold(f"{name.upper()}:{format_value(name, value)}"))
+    return "".join(lines)
+
+
+def render_calendar(properties: dict, events):
+    """
+    Yields an iCalendar document one chunk per event.
+
+    Args:
+        properties (dict): Calendar properties such as prodid and version.
+        events (iterable): Dicts of event properties keyed by lowercase name.
+    """
+    yield "BEGIN:VCALENDAR\r\n" + render_properties(properties, CALENDAR_ORDER)
+    for event in events:
+        yield (
+            "BEGIN:VEVENT\r\n"
+            + render_properties(event, EVENT_ORDER)
+            + "END:VEVENT\r\n"
+        )
+    yield "END:VCALENDAR\r\n"
@@ -0,0 +1,154 @@
+"""
+Prometheus metrics for upstream calls, caches and feed builds.
+
+Metrics are opt-in: set METRICS_ENABLED=1 to collect them and expose
+/metrics. Under gunicorn, PROMETHEUS_MULTIPROC_DIR must point at a directory
+shared by the workers (gunicorn.conf.py sets one up) so every scrape adds up
+the samples of all workers instead of whichever one answered.
+
+When metrics are disabled, or prometheus_client isn't installed, every
+helper here is a no-op.
+"""
+
+import contextlib
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+    multiprocess = None
+    if ENABLED:
+        logger.warning(
+            {"message": "METRICS_ENABLED is set but prometheus_client is missing"}
+        )
+        ENABLED = False
+
+# Latency buckets in seconds, from cache hits up to slow upstream calls.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+if ENABLED:
+    UPSTREAM_REQUESTS = prometheus_client.Counter(
+        "trakt_ical_upstream_requests_total",
+        "Requests to Trakt, TMDB and MongoDB by service, endpoint and status",
+        ["service", "endpoint", "status"],
+    )
+    UPSTREAM_LATENCY = prometheus_client.Histogram(
+        "trakt_ical_upstream_request_seconds",
+        "Latency of requests to Trakt, TMDB and MongoDB",
+        ["service", "endpoint"],
+        buckets=BUCKETS,
+    )
+    CACHE_EVENTS = prometheus_client.Counter(
+        "trakt_ical_cache_events_total",
+        "Cache hits, misses, stale hits, expiries and evictions by cache",
+        ["cache", "event"],
+    )
+    OPERATION_LATENCY = prometheus_client.Histogram(
+        "trakt_ical_operation_seconds",
+        "Latency of internal operations such as token lookups and renders",
+        ["operation"],
+        buckets=BUCKETS,
+    )
+
+
+@contextlib.contextmanager
+def track_upstream(service: str, endpoint: str):
+    """
+    Times an outbound request. The block should set the "status" key of the
+    yielded dict to the response status; exceptions are counted as "error".
+    """
+    if not ENABLED:
+        yield {}
+        return
+    result = {"status": "error"}
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        UPSTREAM_LATENCY.labels(service, endpoint).observe(
+            time.perf_counter() - started
+        )
+        UPSTREAM_REQUESTS.labels(service, endpoint, str(result["status"])).inc()
+
+
+@contextlib.contextmanager
+def track_operation(operation: str):
+    """
+    Times the block as operation
+    """
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        OPERATION_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+
+def observe_operation(operation: str, seconds: float):
+    """
+    Records an operation timed by the caller
+    """
+    if ENABLED:
+        OPERATION_LATENCY.labels(operation).observe(seconds)
+
+
+def count_cache(cache: str, event: str, amount: int = 1):
+    """
+    Counts a cache event: "hit", "miss", "stale", "expired" or "eviction"
+    """
+    if ENABLED and amount:
+        CACHE_EVENTS.labels(cache, event).inc(amount)
+
+
+def get_event_listeners():
+    """
+    Returns the pymongo command listeners that count and time Mongo queries
+    """
+    if not ENABLED:
+        return []
+    from pymongo import monitoring  # pylint: disable=import-outside-toplevel
+
+    class MongoCommandMetrics(monitoring.CommandListener):
+        def started(self, event):
+            pass
+
+        def succeeded(self, event):
+            self._record(event, "ok")
+
+        def failed(self, event):
+            self._record(event, "error")
+
+        @staticmethod
+        def _record(event, status):
+            UPSTREAM_LATENCY.labels("mongo", event.command_name).observe(
+                event.duration_micros / 1e6
+            )
+            UPSTREAM_REQUESTS.labels("mongo", event.command_name, status).inc()
+
+    return [MongoCommandMetrics()]
+
+
+def render():
+    """
+    Returns the metrics of every worker in the Prometheus text format and its
+    content type
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return (
+        prometheus_client.generate_latest(registry),
+        prometheus_client.CONTENT_TYPE_LATEST,
+    )
@@ -0,0 +1,206 @@
+"""
+Bulk pre-rendering of every user's feeds, so the web tier almost never has to
+build a feed inline.
+
+Feeds are written into the serving cache, or exported as static files that a
+web server can answer subscription polls from without running any Python:
+output_dir/<user_id>/<calendar_type>.ics, with .gz and .br variants next to
+it for gzip_static/brotli_static style serving. The user_id is random and
+unguessable, so directory listings must stay disabled.
+
+Users are spread over a process pool. Each process keeps its own bounded
+Trakt and TMDB pools, and TMDB lookups are shared between users (and with
+the web tier) through the host-wide TMDB cache.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import os
+import tempfile
+import time
+
+import compression
+import rate_limit
+import serve_ical
+import tmdb_api
+import trakt_api
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TYPES = ("shows", "movies")
+
+# Upstream responses received by this process, by service.
+_upstream_calls = collections.Counter()
+
+
+def init_worker(max_connections: int = None):
+    """
+    Sets up a pool process: caps its upstream concurrency, queues its
+    requests behind interactive ones and counts the responses of its Trakt
+    and TMDB sessions
+    """
+    rate_limit.default_lane = rate_limit.BACKGROUND
+    if max_connections:
+        trakt_api.MAX_WORKERS = max_connections
+        tmdb_api.MAX_CONCURRENCY = max_connections
+    trakt_api.get_session().hooks["response"].append(count_response("trakt"))
+    tmdb_api.get_session().hooks["response"].append(count_response("tmdb"))
+
+
+def count_response(service: str):
+    """
+    Returns a requests response hook counting responses from service
+    """
+
+    def hook(response, *args, **kwargs):
+        _upstream_calls[service] += 1
+
+    return hook
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Replaces the file at path with data so readers never see a partial file
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def export_feed(output_dir: str, key: str, calendar_type: str, body: str):
+    """
+    Writes a feed and its compressed variants under output_dir/key/ and
+    returns whether anything changed. An unchanged feed is left alone, so the
+    mtime static servers send as Last-Modified only moves with the content.
+    """
+    directory = os.path.join(output_dir, serve_ical.clean_key(key))
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{calendar_type}.ics")
+    data = body.encode("utf-8")
+    try:
+        with open(path, "rb") as file:
+            if file.read() == data:
+                return False
+    except FileNotFoundError:
+        pass
+    variants = compression.compress_variants(data)
+    for encoding, suffix in (("gzip", ".gz"), ("br", ".br")):
+        if encoding in variants:
+            write_atomic(path + suffix, variants[encoding])
+        elif os.path.exists(path + suffix):
+            # A stale variant would be served instead of the new feed
+            os.unlink(path + suffix)
+    write_atomic(path, data)
+    return True
+
+
+def render_user(key: str, calendar_types, output_dir: str = None):
+    """
+    Builds the user's feeds with the default window and stores them in the
+    serving cache, or exports them to output_dir if given. Returns the number
+    of feeds rendered, changed and failed and the upstream calls it took.
+    """
+    before = collections.Counter(_upstream_calls)
+    rendered = changed = failed = 0
+    days_ago, period = serve_ical.get_window(None, None)
+    with serve_ical.app.app_context():
+        for calendar_type in calendar_types:
+            try:
+                with tmdb_api.track_failures() as failures:
+                    body = serve_ical.render_calendar_body(
+                        calendar_type, key, days_ago, period
+                    )
+                if failures:
+                    raise RuntimeError(f"{len(failures)} TMDB lookups failed")
+                if output_dir:
+                    changed += export_feed(output_dir, key, calendar_type, body)
+                else:
+                    cache_key = serve_ical.get_feed_key(
+                        "calendar_ical", key, calendar_type, days_ago, period
+                    )
+                    # Like the export, count a feed as changed when its ETag
+                    # differs from the last one built for it
+                    validators = serve_ical.get_cache().get(f"{cache_key}:validators")
+                    feed = serve_ical.store_feed(cache_key, body)
+                    changed += not validators or validators["etag"] != feed["etag"]
+                rendered += 1
+            except Exception as error:  # pylint: disable=broad-except
+                failed += 1
+                logger.warning(
+                    {
+                        "message": "Failed to pre-render feed",
+                        "info": {
+                            "user_id": key,
+                            "calendar_type": calendar_type,
+                            "error": error,
+                        },
+                    }
+                )
+    return {
+        "rendered": rendered,
+        "changed": changed,
+        "failed": failed,
+        "calls": dict(_upstream_calls - before),
+    }
+
+
+def prerender(
+    calendar_types=DEFAULT_TYPES,
+    processes: int = None,
+    max_connections: int = None,
+    output_dir: str = None,
+):
+    """
+    Pre-renders the feeds of every user in the users collection and returns
+    a throughput report.
+
+    Args:
+        calendar_types (iterable): Calendar types to build for each user.
+        processes (int): Size of the process pool. Defaults to the CPU count.
+        max_connections (int): Upstream requests each process may run at
+            once, per service. Defaults to TRAKT_MAX_WORKERS and
+            TMDB_MAX_CONCURRENCY.
+        output_dir (str): Export the feeds to this directory instead of
+            storing them in the serving cache.
+    """
+    calendar_types = tuple(calendar_types)
+    keys = [
+        user["user_id"]
+        for user in serve_ical.get_collection().find({}, {"user_id": 1, "_id": 0})
+    ]
+    processes = processes or os.cpu_count() or 1
+
+    report = {"users": len(keys), "rendered": 0, "changed": 0, "failed": 0}
+    calls = collections.Counter()
+    started = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=init_worker, initargs=(max_connections,)
+    ) as executor:
+        futures = [
+            executor.submit(render_user, key, calendar_types, output_dir)
+            for key in keys
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            report["rendered"] += result["rendered"]
+            report["changed"] += result["changed"]
+            report["failed"] += result["failed"]
+            calls.update(result["calls"])
+    report["seconds"] = time.perf_counter() - started
+    report["users_per_second"] = len(keys) / report["seconds"] if keys else 0.0
+    report["calls_per_user"] = {
+        service: count / len(keys) for service, count in calls.items()
+    }
+    return report
@@ -0,0 +1,311 @@
+"""
+Outbound rate limiting shared by every worker on the host.
+
+Each upstream service has a token bucket kept in a small state file that is
+only updated under an flock, so gunicorn workers and prerender processes all
+draw from one budget. Responses feed back into it: a Retry-After, or a Trakt
+X-Ratelimit header with nothing remaining, pauses the service for everyone
+until the limit resets. 429s and 5xx gateway errors are retried with
+jittered exponential backoff.
+
+Requests run in a lane. Interactive requests (anything a user is waiting on)
+may drain the bucket, while background work such as stale-feed refreshes and
+prerendering leaves a reserve, so under contention interactive requests go
+first.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import email.utils
+import fcntl
+import json
+import os
+import random
+import struct
+import threading
+import time
+
+import requests
+
+import metrics
+from single_flight import LOCK_DIR
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Sustained requests per second and burst size of each service, for the whole
+# host. A rate of 0 turns the bucket off (retries still apply). Trakt allows
+# 1000 GETs per 5 minutes per user and TMDB around 50 requests per second.
+LIMITS = {
+    "trakt": (
+        float(os.environ.get("TRAKT_RATE_LIMIT", "10")),
+        int(os.environ.get("TRAKT_RATE_BURST", "20")),
+    ),
+    "tmdb": (
+        float(os.environ.get("TMDB_RATE_LIMIT", "40")),
+        int(os.environ.get("TMDB_RATE_BURST", "40")),
+    ),
+}
+
+# Share of the burst that background requests leave for interactive ones.
+BACKGROUND_RESERVE = float(os.environ.get("RATE_LIMIT_BACKGROUND_RESERVE", "0.25"))
+
+# Longest a request waits for a token, or for a rate limit to reset, before
+# giving up with RateLimited.
+MAX_WAIT = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "30"))
+
+MAX_RETRIES = int(os.environ.get("UPSTREAM_MAX_RETRIES", "3"))
+BACKOFF_BASE = 0.5
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# tokens, last refill and paused-until, as wall clock seconds
+_STATE = struct.Struct("ddd")
+
+_lane = contextvars.ContextVar("lane", default=None)
+# Lane used when none is set, e.g. BACKGROUND in prerender processes.
+default_lane = INTERACTIVE
+
+_limiters = {}
+_registry_lock = threading.Lock()
+
+
+class RateLimited(requests.RequestException):
+    """
+    Raised when an upstream stays rate limited for longer than we can wait
+    """
+
+    def __init__(self, service: str, retry_after: float, response=None):
+        super().__init__(
+            f"{service} is rate limited for {retry_after:.0f}s", response=response
+        )
+        self.service = service
+        self.retry_after = retry_after
+
+
+@contextlib.contextmanager
+def lane(name: str):
+    """
+    Runs the block's upstream requests in the name lane
+    """
+    token = _lane.set(name)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+def get_lane():
+    return _lane.get() or default_lane
+
+
+def bind(fn):
+    """
+    Returns fn wrapped to run in the caller's lane, for handing to a pool
+    thread, which doesn't inherit it
+    """
+    current = get_lane()
+
+    def run(*args, **kwargs):
+        with lane(current):
+            return fn(*args, **kwargs)
+
+    return run
+
+
+class RateLimiter:
+    """
+    Token bucket for one service, shared through a state file. Threads in one
+    process queue on a regular lock and processes on an flock of the file.
+    """
+
+    def __init__(self, service: str, rate: float, burst: int):
+        self.service = service
+        self.rate = rate
+        self.burst = burst
+        self.path = os.path.join(LOCK_DIR, f"rate-{service}.state")
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def acquire(self, lane_name: str = None):
+        """
+        Waits for a token. Raises RateLimited if that would take longer than
+        MAX_WAIT.
+        """
+        started = time.monotonic()
+        while (wait := self._poll(lane_name, started)) > 0:
+            time.sleep(wait)
+        self._observe_wait(started)
+
+    async def acquire_async(self, lane_name: str = None):
+        """
+        acquire() for the event loop, which keeps serving while this waits.
+        The shared state is locked and read on a thread, so a contended lock
+        doesn't stall the loop.
+        """
+        started = time.monotonic()
+        while (wait := await asyncio.to_thread(self._poll, lane_name, started)) > 0:
+            await asyncio.sleep(wait)
+        self._observe_wait(started)
+
+    def _poll(self, lane_name: str, started: float):
+        """
+        Takes a token and returns 0, or returns how long to sleep before
+        trying again
+        """
+        lane_name = lane_name or get_lane()
+        reserve = 0 if lane_name == INTERACTIVE else self.burst * BACKGROUND_RESERVE
+        wait = self._take(reserve)
+        if wait <= 0:
+            return 0
+        if time.monotonic() - started + wait > MAX_WAIT:
+            raise RateLimited(self.service, wait)
+        # A little jitter keeps waiting workers from retrying in lockstep
+        return wait + random.uniform(0, 0.05)
+
+    def _observe_wait(self, started: float):
+        waited = time.monotonic() - started
+        if waited > 0.001:
+            metrics.observe_operation(f"rate_limit_wait_{self.service}", waited)
+
+    def pause(self, seconds: float):
+        """
+        Stops every worker from calling the service for the next seconds
+        """
+
+        def update(state):
+            tokens, updated, paused_until = state
+            return tokens, updated, max(paused_until, time.time() + seconds)
+
+        self._update(update)
+
+    def _take(self, reserve: float):
+        """
+        Takes a token if more than reserve are left and returns 0, otherwise
+        returns how long to wait before trying again
+        """
+        result = []
+
+        def update(state):
+            tokens, updated, paused_until = state
+            now = time.time()
+            if paused_until > now:
+                result.append(paused_until - now)
+                return state
+            if self.rate <= 0:
+                result.append(0)
+                return state
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= reserve + 1:
+                result.append(0)
+                return tokens - 1, now, paused_until
+            result.append((reserve + 1 - tokens) / self.rate)
+            return tokens, now, paused_until
+
+        self._update(update)
+        return result[0]
+
+    def _update(self, update):
+        with self._lock:
+            fd = self._get_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                data = os.pread(fd, _STATE.size, 0)
+                if len(data) == _STATE.size:
+                    state = _STATE.unpack(data)
+                else:
+                    state = (float(self.burst), time.time(), 0.0)
+                new_state = update(state)
+                if new_state is not state:
+                    os.pwrite(fd, _STATE.pack(*new_state), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def _get_fd(self):
+        # A descriptor inherited through fork shares its flock with the
+        # parent, so every process opens its own
+        if self._pid != os.getpid():
+            os.makedirs(LOCK_DIR, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+
+def get_limiter(service: str):
+    """
+    Returns the shared rate limiter of service
+    """
+    with _registry_lock:
+        if service not in _limiters:
+            _limiters[service] = RateLimiter(service, *LIMITS[service])
+        return _limiters[service]
+
+
+def get_retry_after(response):
+    """
+    Returns how many seconds the response asks us to back off for, or None
+    """
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(value)
+                return max(0.0, retry_at.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    # Trakt describes its limits as JSON, e.g.
+    # {"name": "AUTHED_API_GET_LIMIT", "remaining": 0, "until": "..."}
+    value = response.headers.get("X-Ratelimit")
+    if value:
+        try:
+            limit = json.loads(value)
+            if int(limit.get("remaining", 1)) <= 0 and limit.get("until"):
+                until = datetime.datetime.fromisoformat(
+                    limit["until"].replace("Z", "+00:00")
+                )
+                return max(0.0, until.timestamp() - time.time())
+        except (TypeError, ValueError, AttributeError):
+            pass
+    return None
+
+
+def send(service: str, session, method: str, url: str, endpoint: str, **kwargs):
+    """
+    Sends a request to service through its rate limiter and returns the
+    response. Rate limited and gateway error responses are retried with
+    jittered exponential backoff; a 429 that outlasts the retries raises
+    RateLimited. Only use this for idempotent requests.
+    """
+    limiter = get_limiter(service)
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.acquire()
+        with metrics.track_upstream(service, endpoint) as result:
+            response = session.request(method, url, **kwargs)
+            result["status"] = response.status_code
+        retry_after = get_retry_after(response)
+        if retry_after:
+            limiter.pause(retry_after)
+        if response.status_code not in RETRY_STATUSES:
+            return response
+        delay = get_retry_delay(attempt, retry_after)
+        if delay is None:
+            break
+        time.sleep(delay)
+    if response.status_code == 429:
+        raise RateLimited(service, retry_after or 0, response=response)
+    return response
+
+
+def get_retry_delay(attempt: int, retry_after: float = None):
+    """
+    Returns how long to wait before retrying a failed attempt (counted from
+    0), with full jitter, or None if it shouldn't be retried
+    """
+    delay = max(retry_after or 0, random.uniform(0, BACKOFF_BASE * 2**attempt))
+    if attempt >= MAX_RETRIES or delay > MAX_WAIT:
+        return None
+    return delay
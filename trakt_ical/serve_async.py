@@ -0,0 +1,565 @@
+"""
+Optional asyncio serving mode.
+
+The feed, preview and user routes run on an aiohttp event loop with async
+Trakt, TMDB and MongoDB clients, so one process can keep hundreds of polls
+and builds in flight while they wait on upstreams. Every other route (sign
+in, the landing page, assets, /metrics) and the rarer request shapes, such
+as paged previews, are handed to the Flask app on a thread, so its
+behaviour stays the reference. The feed cache, single-flight locks and rate
+limits are the same ones the Flask workers use, so both modes can share a
+host.
+
+Needs aiohttp. Run with ``python __main__.py --serve --async``, or under
+gunicorn with ``gunicorn serve_async:create_app --worker-class
+aiohttp.GunicornWebWorker``.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import datetime
+import logging
+import threading
+
+import aiohttp
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import http_date, is_resource_modified, parse_accept_header
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+import async_api
+import compression
+import metrics
+import rate_limit
+import serve_ical
+import tmdb_api
+from serve_ical import (
+    CALENDAR_TYPES,
+    TRAKT_URL,
+    TRAKT_API_URL,
+    app,
+    clean_key,
+    get_cache,
+    get_feed_key,
+    get_flight_name,
+    get_generation,
+    get_window,
+    is_fresh,
+    is_page_request,
+    profiles,
+    store_feed,
+    tokens,
+)
+from single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+_flights = {}
+_refreshing = set()
+_tasks = set()
+
+
+@contextlib.asynccontextmanager
+async def flight(name: str):
+    """
+    SingleFlight for coroutines. Tasks in this process queue on an asyncio
+    lock, so at most one thread per name waits on the lock shared with the
+    other workers.
+    """
+    entry = _flights.setdefault(name, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            lock = SingleFlight(name)
+            await asyncio.to_thread(lock.acquire)
+            try:
+                yield
+            finally:
+                lock.release()
+    finally:
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del _flights[name]
+
+
+async def load_token(key: str):
+    user = await async_api.get_collection().find_one(
+        {"user_id": key}, {"token": 1, "_id": 0}
+    )
+    if not user:
+        return None
+    return serve_ical.decrypt(user["token"])
+
+
+async def get_token(key: str):
+    """
+    serve_ical.get_token without blocking the event loop
+    """
+    with metrics.track_operation("get_token"):
+        return await _get_token(key)
+
+
+async def _get_token(key: str):
+    key = clean_key(key)
+    user_token = tokens.get(key)
+    if user_token is not None:
+        return user_token
+
+    user_token = await load_token(key)
+    if user_token is None:
+        return None
+    if serve_ical.get_token_ttl(user_token) > 0:
+        tokens.set(key, user_token, serve_ical.get_token_ttl(user_token))
+        return user_token
+
+    # Refresh tokens are single use, so only one task or worker may rotate a
+    # given user's token, and it is never retried
+    async with flight(f"token:{key}"):
+        user_token = await load_token(key)
+        if user_token is None:
+            return None
+        if serve_ical.get_token_ttl(user_token) > 0:
+            tokens.set(key, user_token, serve_ical.get_token_ttl(user_token))
+            return user_token
+        logger.info({"message": "Token is expired", "info": {"user_id": key}})
+        with metrics.track_upstream("trakt", "oauth_token") as result:
+            async with async_api.get_session().post(
+                f"{TRAKT_URL}/oauth/token",
+                data=serve_ical.get_refresh_data(user_token),
+                timeout=aiohttp.ClientTimeout(total=5),
+            ) as response:
+                result["status"] = response.status
+                response.raise_for_status()
+                user_token = serve_ical.check_refreshed_token(
+                    await response.json(content_type=None)
+                )
+        await async_api.get_collection().update_one(
+            {"user_id": key}, {"$set": {"token": serve_ical.encrypt(user_token)}}
+        )
+        tokens.set(key, user_token, serve_ical.get_token_ttl(user_token))
+        return user_token
+
+
+async def get_user_info(trakt_access_token: str):
+    """
+    Returns the user info for the given access token
+    """
+    response = await async_api.send(
+        "trakt",
+        "GET",
+        f"{TRAKT_API_URL}/users/settings",
+        "users_settings",
+        headers=serve_ical.get_user_info_headers(trakt_access_token),
+    )
+    return await response.json(content_type=None)
+
+
+async def get_trakt_api(key: str):
+    trakt_access_token = await get_token(key)
+    return async_api.AsyncTraktAPI(
+        trakt_access_token["access_token"],
+        user_id=key,
+        generation=await asyncio.to_thread(get_generation, key),
+    )
+
+
+async def render_calendar_body(calendar_type: str, key: str, days_ago, period):
+    """
+    Returns the user's whole iCal feed as a string
+    """
+    with metrics.track_operation("render_ical"):
+        trakt_api = await get_trakt_api(key)
+        return await trakt_api.get_calendar(calendar_type, days_ago, period)
+
+
+async def build_calendar_preview(calendar_type: str, key: str, days_ago, period):
+    """
+    Returns the JSON preview body for the user's calendar
+    """
+    with metrics.track_operation("render_preview"):
+        trakt_api = await get_trakt_api(key)
+        kinds = ["shows", "movies"] if calendar_type == "all" else [calendar_type]
+        windows = await trakt_api.get_windows(kinds, days_ago, period)
+        groups = serve_ical.group_preview_entries(
+            windows.get("shows", []) + windows.get("movies", [])
+        )
+        entries = [entry for _, day in groups for entry in day]
+        tmdb = trakt_api.tmdb
+        lookups = {"shows": tmdb.get_show_summary, "movies": tmdb.get_movie_summary}
+        summaries = await tmdb.get_many(
+            lambda lookup: lookups[lookup[0]](lookup[1]),
+            serve_ical.get_preview_lookups(entries),
+        )
+        items = serve_ical.enrich_preview_entries(
+            calendar_type, entries, summaries=summaries
+        )
+        return serve_ical.render_preview(calendar_type, groups, items)
+
+
+def read_cache(cache_key: str):
+    """
+    Reads the feed cache; run on a thread, as it may wait on SQLite
+    """
+    return get_cache().get(cache_key)
+
+
+async def get_feed(cache_key: str, rebuild, flight_name: str):
+    """
+    serve_ical.get_feed, with stale feeds refreshed on a task. rebuild() must
+    return a coroutine.
+    """
+    feed = await asyncio.to_thread(read_cache, cache_key)
+    cache_name = cache_key.split(":", 1)[0]
+    if feed is None:
+        metrics.count_cache(cache_name, "miss")
+    elif is_fresh(feed):
+        metrics.count_cache(cache_name, "hit")
+    else:
+        metrics.count_cache(cache_name, "stale")
+        refresh_feed(cache_key, rebuild, flight_name)
+    return feed
+
+
+def refresh_feed(cache_key: str, rebuild, flight_name: str):
+    """
+    Rebuilds a feed in the background unless it is already being rebuilt on
+    this host. On failure the stale feed is left in place.
+    """
+    if cache_key in _refreshing or serve_ical.is_refresh_backed_off(cache_key):
+        return
+    _refreshing.add(cache_key)
+
+    async def run():
+        lock = SingleFlight(flight_name)
+        try:
+            if not lock.acquire(timeout=0):
+                return
+            feed = await asyncio.to_thread(read_cache, cache_key)
+            if feed is not None and is_fresh(feed):
+                return
+            with app.app_context(), rate_limit.lane(rate_limit.BACKGROUND):
+                with tmdb_api.track_failures() as failures:
+                    body = await rebuild()
+            if failures:
+                serve_ical.record_refresh_failure(cache_key)
+                return
+            await asyncio.to_thread(store_feed, cache_key, body)
+        except Exception as error:  # pylint: disable=broad-except
+            serve_ical.record_refresh_failure(cache_key)
+            logger.exception(
+                {
+                    "message": "Failed to refresh stale feed",
+                    "info": {"cache_key": cache_key, "error": error},
+                }
+            )
+        finally:
+            lock.release()
+            _refreshing.discard(cache_key)
+
+    # The loop only keeps weak references to tasks
+    task = asyncio.create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def build_feed(cache_key: str, build, flight_name: str):
+    """
+    Builds and caches a missing feed. Only one request per feed builds it;
+    the others wait here and are then answered from the cache.
+    """
+    async with flight(flight_name):
+        feed = await asyncio.to_thread(read_cache, cache_key)
+        if feed is None:
+            with tmdb_api.track_failures() as failures:
+                body = await build()
+            feed = await asyncio.to_thread(store_feed, cache_key, body, not failures)
+    return feed
+
+
+def feed_response(request: web.Request, feed: dict, content_type: str, headers=None):
+    """
+    serve_ical.conditional_response for aiohttp: sends the stored variant
+    that best matches Accept-Encoding with the feed's validators, or a 304
+    """
+    variants = feed.get("encoded", {})
+    encoding = compression.choose_encoding(
+        parse_accept_header(request.headers.get("Accept-Encoding")), variants
+    )
+    etag = feed["etag"]
+    response_headers = {"Vary": "Accept-Encoding", **(headers or {})}
+    if encoding is not None:
+        body = variants[encoding]
+        response_headers["Content-Encoding"] = encoding
+        etag = f"{etag}-{encoding}"
+    else:
+        body = feed["body"].encode("utf-8")
+    response_headers["ETag"] = f'"{etag}"'
+    response_headers["Last-Modified"] = http_date(feed["last_modified"])
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "HTTP_IF_NONE_MATCH": request.headers.get("If-None-Match", ""),
+        "HTTP_IF_MODIFIED_SINCE": request.headers.get("If-Modified-Since", ""),
+    }
+    last_modified = datetime.datetime.fromtimestamp(
+        feed["last_modified"], datetime.timezone.utc
+    )
+    if not is_resource_modified(environ, etag=etag, last_modified=last_modified):
+        return web.Response(status=304, headers=response_headers)
+    return web.Response(body=body, content_type=content_type, headers=response_headers)
+
+
+async def calendar_ical(request: web.Request):
+    """
+    serve_ical.calendar_ical on the event loop. Requests without a key are
+    left to Flask.
+    """
+    calendar_type = request.match_info["calendar_type"]
+    key = clean_key(request.query.get("key"))
+    if not key:
+        return await call_flask(request)
+    try:
+        days_ago, period = get_window(
+            request.query.get("days_ago"), request.query.get("period")
+        )
+    except ValueError:
+        return web.json_response(
+            {"error": "days_ago and period must be integers"}, status=400
+        )
+    cache_key = await asyncio.to_thread(
+        get_feed_key, "calendar_ical", key, calendar_type, days_ago, period
+    )
+    flight_name = get_flight_name("calendar_ical", key, calendar_type, days_ago, period)
+
+    def build():
+        return render_calendar_body(calendar_type, key, days_ago, period)
+
+    feed = await get_feed(cache_key, build, flight_name)
+    if feed is None:
+        if await get_token(key) is None:
+            raise web.HTTPFound("/auth")
+        try:
+            feed = await build_feed(cache_key, build, flight_name)
+        except ValueError as message:
+            return web.json_response({"error": str(message)}, status=400)
+    filename = f"trakt-calendar-{calendar_type}.ics"
+    return feed_response(
+        request,
+        feed,
+        "text/calendar",
+        {
+            "Cache-Control": "max-age=3600",
+            "Content-Disposition": f"attachment; filename={filename}",
+        },
+    )
+
+
+async def get_calendar_preview(request: web.Request):
+    """
+    serve_ical.get_calendar_preview on the event loop. Paged and streamed
+    previews are left to Flask.
+    """
+    calendar_type = request.match_info["calendar_type"]
+    accept = parse_accept_header(request.headers.get("Accept"), MIMEAccept)
+    if is_page_request(request.query, accept):
+        return await call_flask(request)
+    key = clean_key(request.query.get("key"))
+    if not key:
+        return web.Response(text="No key provided", status=400)
+    try:
+        days_ago, period = get_window(
+            request.query.get("days_ago"), request.query.get("period")
+        )
+    except ValueError:
+        return web.json_response(
+            {"error": "days_ago and period must be integers"}, status=400
+        )
+    cache_key = await asyncio.to_thread(
+        get_feed_key, "get_calendar_preview", key, calendar_type, days_ago, period
+    )
+    flight_name = get_flight_name(
+        "get_calendar_preview", key, calendar_type, days_ago, period
+    )
+
+    def build():
+        return build_calendar_preview(calendar_type, key, days_ago, period)
+
+    feed = await get_feed(cache_key, build, flight_name)
+    if feed is None:
+        if await get_token(key) is None:
+            raise web.HTTPNotFound()
+        try:
+            feed = await build_feed(cache_key, build, flight_name)
+        except ValueError as message:
+            return web.json_response({"error": str(message)}, status=400)
+    return feed_response(
+        request,
+        feed,
+        "application/json",
+        {"Access-Control-Allow-Origin": "*"},
+    )
+
+
+async def get_user(request: web.Request):
+    """
+    Returns the username and slug of a user
+    """
+    user_id = request.match_info["user_id"]
+    profile = profiles.get(user_id)
+    if profile is None:
+        user = await async_api.get_collection().find_one(
+            {"user_id": user_id}, {"user_slug": 1, "_id": 0}
+        )
+        if not user:
+            raise web.HTTPNotFound()
+        trakt_access_token = (await get_token(user_id))["access_token"]
+        username = (await get_user_info(trakt_access_token))["user"]["username"]
+        profile = {"username": username, "slug": user["user_slug"]}
+        profiles.set(user_id, profile)
+    return web.json_response(profile)
+
+
+def run_flask(environ: dict, loop, queue: asyncio.Queue, stop: threading.Event):
+    """
+    Runs the Flask app on this thread and passes its status and headers, then
+    every chunk of the body as it is produced, and finally None to queue.
+    Streamed responses are consumed on this one thread, so their request
+    context stays valid. Stops early once stop is set.
+    """
+
+    def put(item):
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    try:
+        app_iter, status, headers = run_wsgi_app(app, environ)
+        try:
+            put((status, headers))
+            for chunk in app_iter:
+                if stop.is_set():
+                    break
+                if chunk:
+                    put(chunk)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+    finally:
+        put(None)
+
+
+async def call_flask(request: web.Request):
+    """
+    Serves the request with the Flask app on a worker thread, streaming its
+    response as it is produced
+    """
+    body = await request.read()
+    environ = EnvironBuilder(
+        path=request.path,
+        base_url=f"{request.scheme}://{request.host}",
+        query_string=request.query_string,
+        method=request.method,
+        headers=[
+            (name, value)
+            for name, value in request.headers.items()
+            if name.lower() not in ("content-length", "content-type")
+        ],
+        content_type=request.headers.get("Content-Type"),
+        data=body,
+    ).get_environ()
+    environ["REMOTE_ADDR"] = request.remote or ""
+    # Bounded, so a slow client holds back the Flask thread rather than
+    # buffering the body here
+    queue = asyncio.Queue(maxsize=16)
+    stop = threading.Event()
+    loop = asyncio.get_running_loop()
+    # Flask pushes its own contexts, so the thread must not inherit the app
+    # context of this handler; streamed responses would share and unwind it
+    worker = loop.run_in_executor(
+        None, contextvars.Context().run, run_flask, environ, loop, queue, stop
+    )
+    try:
+        started = await queue.get()
+        if started is None:
+            # The app raised before it responded
+            await worker
+        status, headers = started
+        code, _, reason = status.partition(" ")
+        response = web.StreamResponse(status=int(code), reason=reason or None)
+        for name, value in headers.items():
+            if name.lower() == "content-length":
+                response.content_length = int(value)
+            elif name.lower() != "transfer-encoding":
+                response.headers.add(name, value)
+        await response.prepare(request)
+        try:
+            while (chunk := await queue.get()) is not None:
+                await response.write(chunk)
+        except ConnectionResetError:
+            # The client went away mid-stream
+            return response
+        await worker
+        await response.write_eof()
+        return response
+    finally:
+        # If the client went away, let the thread finish without blocking on
+        # a full queue
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+
+
+@web.middleware
+async def app_context(request: web.Request, handler):
+    """
+    Runs every handler in a Flask app context, which the feed cache needs,
+    and turns upstream rate limits into 503s
+    """
+    with app.app_context():
+        try:
+            return await handler(request)
+        except rate_limit.RateLimited as error:
+            logger.warning(
+                {
+                    "message": "Upstream rate limited",
+                    "info": {"path": request.path, "error": str(error)},
+                }
+            )
+            return web.json_response(
+                {"error": "Upstream is busy, try again later"},
+                status=503,
+                headers={"Retry-After": str(max(1, int(error.retry_after + 0.5)))},
+            )
+
+
+async def on_startup(web_app: web.Application):
+    # Sign-in runs on Flask, which also makes sure the indexes exist
+    await asyncio.to_thread(serve_ical.get_collection)
+    serve_ical.init_sentry()
+
+
+async def on_cleanup(web_app: web.Application):
+    await async_api.close()
+
+
+async def create_app():
+    """
+    Returns the aiohttp application
+    """
+    web_app = web.Application(middlewares=[app_context])
+    calendar_types = "|".join(CALENDAR_TYPES)
+    web_app.router.add_get(f"/{{calendar_type:{calendar_types}}}", calendar_ical)
+    web_app.router.add_get(
+        f"/{{calendar_type:{calendar_types}}}/json", get_calendar_preview
+    )
+    web_app.router.add_get("/api/user/{user_id}", get_user)
+    web_app.router.add_route("*", "/{path:.*}", call_flask)
+    web_app.on_startup.append(on_startup)
+    web_app.on_cleanup.append(on_cleanup)
+    return web_app
+
+
+def serve(host: str = "0.0.0.0", port: int = 8000):
+    """
+    Run the app on an event loop
+    """
+    serve_ical.ensure_secret_key()
+    web.run_app(create_app(), host=host, port=int(port))
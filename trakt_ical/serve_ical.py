@@ -3,10 +3,13 @@ This file contains the code for the Flask app that serves the iCal file.
 """
 
 import datetime
+import hashlib
+import math
 import os
 import re
-import tempfile
 import logging
+import threading
+import time
 
 import pymongo
 import requests
@@ -20,63 +23,215 @@ from flask import (
     redirect,
     request,
     send_from_directory,
+    stream_with_context,
     url_for,
 )
 from flask_caching import Cache
-from util import decrypt, encrypt
-import sentry_sdk
+import compression
+import metrics
+import rate_limit
+import timing
+import tmdb_api
+from util import TTLCache, decrypt, encrypt
+from single_flight import SingleFlight
 
-from trakt_api import TraktAPI
+from trakt_api import TRAKT_API_URL, TraktAPI
 from tmdb_api import TMDB
 
-col = pymongo.MongoClient(os.environ.get("MONGO_URL")).trakt_ical.users
-
 logger = logging.getLogger(__name__)
 
+# Feeds are cached in memory in each worker, in front of an SQLite file shared
+# by every worker on the host. Both tiers are bounded: the memory tier by
+# bytes, the file by entries.
 config = {
     "DEBUG": False,
-    "CACHE_TYPE": "FileSystemCache",
+    "CACHE_TYPE": "tiered_cache.TieredCache",
     "CACHE_DEFAULT_TIMEOUT": 3600,
-    "CACHE_DIR": "./cache",
+    "CACHE_SQLITE_PATH": os.environ.get("FEED_CACHE_PATH", "./cache/feeds.sqlite3"),
+    "CACHE_MAX_ENTRIES": int(os.environ.get("FEED_CACHE_MAX_ENTRIES", "100000")),
+    "CACHE_MEMORY_MAX_BYTES": int(
+        os.environ.get("FEED_CACHE_MEMORY_BYTES", str(64 * 1024 * 1024))
+    ),
+    "CACHE_MEMORY_TTL": int(os.environ.get("FEED_CACHE_MEMORY_TTL", "60")),
 }
 app = Flask(__name__, static_folder="frontend/dist")
 app.config.from_mapping(config)
-cache = Cache(app)
-
-tmdb = TMDB()
+cache = Cache()
 
 load_dotenv(override=True)
 
-sentry_sdk.init(
-    dsn=os.environ.get("SENTRY_DSN"),
-    # Set traces_sample_rate to 1.0 to capture 100%
-    # of transactions for performance monitoring.
-    traces_sample_rate=1.0,
-    # Set profiles_sample_rate to 1.0 to profile 100%
-    # of sampled transactions.
-    # We recommend adjusting this value in production.
-    profiles_sample_rate=1.0,
-)
+# Mongo, Sentry, TMDB and the feed cache are set up on first use rather than
+# on import, so forked workers and CLI runs only pay for what they touch.
+_mongo_client = None
+_mongo_pid = None
+_mongo_lock = threading.Lock()
+_cache_ready = False
+_sentry_ready = False
+_tmdb = None
+_init_lock = threading.Lock()
+
+
+def get_collection():
+    """
+    Returns the users collection. MongoClient isn't fork-safe, so each
+    process creates its own on first use and checks the indexes then.
+    """
+    global _mongo_client, _mongo_pid
+    if _mongo_client is None or _mongo_pid != os.getpid():
+        with _mongo_lock:
+            if _mongo_client is None or _mongo_pid != os.getpid():
+                client = pymongo.MongoClient(
+                    os.environ.get("MONGO_URL"),
+                    event_listeners=metrics.get_event_listeners(),
+                )
+                ensure_indexes(client.trakt_ical.users)
+                _mongo_client, _mongo_pid = client, os.getpid()
+    return _mongo_client.trakt_ical.users
+
+
+def ensure_indexes(collection):
+    """
+    Creates the user_id and user_slug indexes every user lookup relies on if
+    they are missing
+    """
+    try:
+        indexed = {
+            index["key"][0][0] for index in collection.index_information().values()
+        }
+        for field in ("user_id", "user_slug"):
+            if field not in indexed:
+                logger.warning(
+                    {"message": "Creating missing index", "info": {"field": field}}
+                )
+                collection.create_index(field)
+    except pymongo.errors.PyMongoError as error:
+        logger.warning({"message": "Failed to check indexes", "info": {"error": error}})
+
+
+def get_cache():
+    """
+    Returns the feed cache, setting up its backend on first use
+    """
+    global _cache_ready
+    if not _cache_ready:
+        with _init_lock:
+            if not _cache_ready:
+                cache.init_app(app)
+                _cache_ready = True
+    return cache
+
+
+def get_tmdb():
+    """
+    Returns the TMDB client shared by this process
+    """
+    global _tmdb
+    if _tmdb is None:
+        with _init_lock:
+            if _tmdb is None:
+                _tmdb = TMDB()
+    return _tmdb
+
+
+@app.before_request
+def init_sentry():
+    """
+    Sets up Sentry in each worker before its first request, if SENTRY_DSN is
+    set
+    """
+    global _sentry_ready
+    if _sentry_ready:
+        return
+    with _init_lock:
+        if _sentry_ready:
+            return
+        _sentry_ready = True
+        if not os.environ.get("SENTRY_DSN"):
+            return
+        import sentry_sdk  # pylint: disable=import-outside-toplevel
+
+        sentry_sdk.init(
+            dsn=os.environ.get("SENTRY_DSN"),
+            # Share of transactions traced for performance monitoring, and
+            # share of traced transactions that are also profiled. Both cost
+            # time on every sampled request, so lower them on busy deployments.
+            traces_sample_rate=float(
+                os.environ.get("SENTRY_TRACES_SAMPLE_RATE", "1.0")
+            ),
+            profiles_sample_rate=float(
+                os.environ.get("SENTRY_PROFILES_SAMPLE_RATE", "1.0")
+            ),
+        )
+
+
+timing.init_app(app)
 
 APPLICATION_ID = os.environ.get("TRAKT_APPLICATION_ID")
 CLIENT_ID = os.environ.get("TRAKT_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("TRAKT_CLIENT_SECRET")
 
+# Base URL of the Trakt website, which hosts the OAuth endpoints.
+TRAKT_URL = os.environ.get("TRAKT_URL", "https://trakt.tv")
+
 MAX_DAYS_AGO = 30
 MAX_PERIOD = 90
 
+CALENDAR_TYPES = ["shows", "movies", "all"]
+
+
+# Decrypted tokens and user profiles are kept in memory for a few minutes so
+# most requests skip Mongo and Fernet entirely. The TTL also bounds how long
+# another worker can keep using a token that was replaced in this one.
+TOKEN_CACHE_TTL = int(os.environ.get("TOKEN_CACHE_TTL", "300"))
+PROFILE_CACHE_TTL = int(os.environ.get("PROFILE_CACHE_TTL", "3600"))
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "4096"))
+
+tokens = TTLCache(maxsize=USER_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, name="tokens")
+profiles = TTLCache(maxsize=USER_CACHE_SIZE, ttl=PROFILE_CACHE_TTL, name="profiles")
+
+
+def get_token_ttl(user_token: dict):
+    """
+    Returns the number of seconds until the token expires
+    """
+    return (
+        user_token["created_at"]
+        + user_token["expires_in"]
+        - datetime.datetime.now().timestamp()
+    )
+
+
+def load_token(key: str):
+    """
+    Reads and decrypts the stored token for the user, or returns None if the
+    user doesn't exist
+    """
+    with timing.phase("mongo"):
+        user = get_collection().find_one({"user_id": key}, {"token": 1, "_id": 0})
+    if not user:
+        return None
+    return decrypt(user["token"])
+
 
 def get_token(key: str):
     """
-    Returns the token for the user with the given key
+    Returns the token for the user with the given key, or None if there is
+    no such user
     """
-    key = re.sub(r"[^a-zA-Z0-9]", "", key)
-    user_token = col.find_one({"user_id": key})["token"]
-    user_token = decrypt(user_token)
-    if (
-        datetime.datetime.now().timestamp()
-        < user_token["created_at"] + user_token["expires_in"]
-    ):
+    with metrics.track_operation("get_token"), timing.phase("token"):
+        return _get_token(key)
+
+
+def _get_token(key: str):
+    key = clean_key(key)
+    user_token = tokens.get(key)
+    if user_token is not None:
+        return user_token
+
+    user_token = load_token(key)
+    if user_token is None:
+        return None
+    if get_token_ttl(user_token) > 0:
         logger.info(
             {
                 "message": "Token is not expired",
@@ -88,45 +243,90 @@ def get_token(key: str):
                 },
             }
         )
+        tokens.set(key, user_token, get_token_ttl(user_token))
         return user_token
-    logger.info(
-        {
-            "message": "Token is expired",
-            "datetime": datetime.datetime.now(),
-            "info": {
-                "user_id": key,
-                "created_at": user_token["created_at"],
-                "expires_in": user_token["expires_in"],
-            },
-        }
-    )
-    data = {
+
+    # Refresh tokens are single use, so only one thread or worker may rotate
+    # a given user's token. Whoever waited re-reads the rotated token.
+    with SingleFlight(f"token:{key}"):
+        user_token = load_token(key)
+        if user_token is None:
+            return None
+        if get_token_ttl(user_token) > 0:
+            tokens.set(key, user_token, get_token_ttl(user_token))
+            return user_token
+        logger.info(
+            {
+                "message": "Token is expired",
+                "datetime": datetime.datetime.now(),
+                "info": {
+                    "user_id": key,
+                    "created_at": user_token["created_at"],
+                    "expires_in": user_token["expires_in"],
+                },
+            }
+        )
+        data = get_refresh_data(user_token)
+        with metrics.track_upstream("trakt", "oauth_token") as result:
+            response = requests.post(f"{TRAKT_URL}/oauth/token", data=data, timeout=5)
+            result["status"] = response.status_code
+        # An error body must never replace the stored token
+        response.raise_for_status()
+        user_token = check_refreshed_token(response.json())
+        with timing.phase("mongo"):
+            get_collection().update_one(
+                {"user_id": key}, {"$set": {"token": encrypt(user_token)}}
+            )
+        tokens.set(key, user_token, get_token_ttl(user_token))
+        return user_token
+
+
+def get_refresh_data(user_token: dict):
+    """
+    Returns the form data that exchanges the token's refresh token for a new
+    token
+    """
+    return {
         "refresh_token": user_token["refresh_token"],
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
         "grant_type": "refresh_token",
         "redirect_uri": os.environ.get("HOST") + "/trakt/callback",
     }
-    response = requests.post("https://trakt.tv/oauth/token", data=data, timeout=5)
-    user_slug = get_user_info(response.json()["access_token"])["user"]["ids"]["slug"]
-    col.update_one(
-        {"user_slug": user_slug}, {"$set": {"token": encrypt(response.json())}}
-    )
-    return response.json()
 
 
-def get_user_info(trakt_access_token: str = None):
+def check_refreshed_token(user_token):
     """
-    Returns the user info for the given access token
+    Returns the token Trakt sent back for a refresh, or raises
+    RequestException if the response isn't a token
     """
-    url = "https://api.trakt.tv/users/settings"
-    headers = {
+    if not isinstance(user_token, dict) or "access_token" not in user_token:
+        raise requests.RequestException("Trakt did not return a refreshed token")
+    return user_token
+
+
+def get_user_info_headers(trakt_access_token: str):
+    return {
         "Content-Type": "application/json",
         "trakt-api-version": "2",
         "trakt-api-key": CLIENT_ID,
         "Authorization": f"Bearer {trakt_access_token}",
     }
-    response = requests.get(url, headers=headers, timeout=5)
+
+
+def get_user_info(trakt_access_token: str = None):
+    """
+    Returns the user info for the given access token
+    """
+    response = rate_limit.send(
+        "trakt",
+        requests,
+        "GET",
+        f"{TRAKT_API_URL}/users/settings",
+        "users_settings",
+        headers=get_user_info_headers(trakt_access_token),
+        timeout=5,
+    )
     return response.json()
 
 
@@ -168,7 +368,7 @@ def authorize():
     </head>
     <body>
     <main>
-    <a href="https://trakt.tv/oauth/authorize?response_type=code&client_id={CLIENT_ID}&redirect_uri={os.environ.get("HOST")}/trakt/callback">Authorize with Trakt</a>
+    <a href="{TRAKT_URL}/oauth/authorize?response_type=code&client_id={CLIENT_ID}&redirect_uri={os.environ.get("HOST")}/trakt/callback">Authorize with Trakt</a>
     <p> You will be redirected to Trakt.tv to authorize this app. </p>
     <p id="countdown">Redirecting in 5 seconds...</p>
     </main>
@@ -180,7 +380,7 @@ def authorize():
             i--;
             if (i == 0) {{
                 clearInterval(interval);
-                window.location.href = "https://trakt.tv/oauth/authorize?response_type=code&client_id={CLIENT_ID}&redirect_uri={os.environ.get("HOST")}/trakt/callback";
+                window.location.href = "{TRAKT_URL}/oauth/authorize?response_type=code&client_id={CLIENT_ID}&redirect_uri={os.environ.get("HOST")}/trakt/callback";
             }}
             document.querySelector("#countdown").innerHTML = "Redirecting in " + i + " seconds...";
         }}, 1000);
@@ -206,15 +406,22 @@ def callback():
         "grant_type": "authorization_code",
         "redirect_uri": os.environ.get("HOST") + "/trakt/callback",
     }
-    response = requests.post("https://trakt.tv/oauth/token", data=data, timeout=5)
+    with metrics.track_upstream("trakt", "oauth_token") as result:
+        response = requests.post(f"{TRAKT_URL}/oauth/token", data=data, timeout=5)
+        result["status"] = response.status_code
     user_slug = get_user_info(response.json()["access_token"])["user"]["ids"]["slug"]
-    if not col.find_one({"user_slug": user_slug}):
+    user = get_collection().find_one({"user_slug": user_slug}, {"user_id": 1, "_id": 0})
+    if not user:
         key = os.urandom(20).hex()
-        col.insert_one(
+        get_collection().insert_one(
             {"user_id": key, "user_slug": user_slug, "token": encrypt(response.json())}
         )
     else:
-        key = col.find_one({"user_slug": user_slug})["user_id"]
+        key = user["user_id"]
+        get_collection().update_one(
+            {"user_id": key}, {"$set": {"token": encrypt(response.json())}}
+        )
+        purge_user(key)
     return redirect(url_for("index") + f"?key={key}")
 
 
@@ -226,14 +433,288 @@ def index():
     return send_from_directory(app.static_folder, "index.html")
 
 
+# Feeds are fresh for FEED_TIMEOUT seconds. For FEED_STALE_GRACE seconds after
+# that the last good body is still served while a rebuild runs in the
+# background, so polls never wait on (or fail with) Trakt and TMDB.
+FEED_TIMEOUT = 3600
+FEED_STALE_GRACE = int(os.environ.get("FEED_STALE_GRACE", "86400"))
+
+# Validators outlive the cached body so an unchanged rebuild keeps its
+# Last-Modified date.
+VALIDATOR_TIMEOUT = max(7 * 86400, FEED_TIMEOUT + FEED_STALE_GRACE)
+
+# After a failed background rebuild, stale polls of that feed don't retry
+# it for FEED_REFRESH_BACKOFF seconds, so an upstream outage costs one
+# attempt per feed and interval rather than one per poll.
+FEED_REFRESH_BACKOFF = int(os.environ.get("FEED_REFRESH_BACKOFF", "300"))
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+_refresh_failures = {}
+_refresh_failures_lock = threading.Lock()
+
+
+def store_feed(cache_key: str, body: str, cache: bool = True):
+    """
+    Caches a rendered feed with its ETag, Last-Modified time and compressed
+    variants, and returns the stored entry. With cache=False, e.g. for a feed
+    built while TMDB lookups failed, the entry is only returned.
+    """
+    etag = hashlib.sha1(body.encode("utf-8")).hexdigest()
+    validators = get_cache().get(f"{cache_key}:validators")
+    if validators and validators["etag"] == etag:
+        last_modified = validators["last_modified"]
+    else:
+        last_modified = int(time.time())
+        if cache:
+            get_cache().set(
+                f"{cache_key}:validators",
+                {"etag": etag, "last_modified": last_modified},
+                timeout=VALIDATOR_TIMEOUT,
+            )
+    feed = {
+        "body": body,
+        "etag": etag,
+        "last_modified": last_modified,
+        "built_at": time.time(),
+    }
+    with timing.phase("compress"):
+        feed["encoded"] = compression.compress_variants(body.encode("utf-8"))
+    if cache:
+        get_cache().set(cache_key, feed, timeout=FEED_TIMEOUT + FEED_STALE_GRACE)
+    return feed
+
+
+def is_fresh(feed: dict):
+    """
+    Returns whether a cached feed is still within FEED_TIMEOUT
+    """
+    return time.time() - feed["built_at"] < FEED_TIMEOUT
+
+
+def clean_key(key: str):
+    """
+    Strips everything but letters and digits from a user key
+    """
+    return re.sub(r"[^a-zA-Z0-9]", "", key or "")
+
+
+def get_window(days_ago, period):
+    """
+    Returns days_ago and period as ints with their defaults applied, so
+    equivalent requests share cache entries and builders. Raises ValueError
+    if either isn't an integer.
+    """
+    return (int(days_ago) if days_ago else 30, int(period) if period else 90)
+
+
+def get_generation(key: str):
+    """
+    Returns the user's cache generation, which is part of every cache key
+    holding the user's data. Users who were never purged are on generation
+    0; that is remembered in L1 like a stored generation, and the lookups are
+    kept out of the feed cache's hit and miss counts.
+    """
+    return get_cache().cache.get_or_default(f"generation:{key}", 0)
+
+
+def purge_user(key: str):
+    """
+    Invalidates every cached feed and calendar of the user at once by moving
+    them to a new generation; the orphaned entries age out on their own.
+    Other workers see the new generation within FEED_CACHE_MEMORY_TTL.
+    """
+    key = clean_key(key)
+    # A timestamp rather than a count, so a generation can't be reused even
+    # if the stored one is evicted
+    get_cache().set(f"generation:{key}", time.time_ns(), timeout=0)
+    tokens.pop(key)
+    profiles.pop(key)
+
+
+def get_feed_key(prefix: str, key: str, calendar_type: str, days_ago, period):
+    """
+    Returns the cache key of a feed from its canonical parameters
+    """
+    generation = get_generation(key)
+    return f"{prefix}:{key}:{generation}:{calendar_type}:{days_ago}:{period}"
+
+
+def get_flight_name(prefix: str, key: str, calendar_type: str, days_ago, period):
+    """
+    Returns the single-flight lock name for a feed build. It carries the
+    prefix of the feed's cache key, so an iCal feed and a preview of the same
+    window are built independently.
+    """
+    return f"feed:{prefix}:{key}:{calendar_type}:{days_ago}:{period}"
+
+
+def get_feed(cache_key: str, rebuild, flight_name: str):
+    """
+    Returns the cached feed for cache_key, or None on a miss. A stale feed is
+    returned as-is and rebuilt in the background with rebuild().
+    """
+    with timing.phase("cache"):
+        feed = get_cache().get(cache_key)
+    cache_name = cache_key.split(":", 1)[0]
+    if feed is None:
+        metrics.count_cache(cache_name, "miss")
+    elif is_fresh(feed):
+        metrics.count_cache(cache_name, "hit")
+    else:
+        metrics.count_cache(cache_name, "stale")
+        refresh_feed(cache_key, rebuild, flight_name)
+    return feed
+
+
+def refresh_feed(cache_key: str, rebuild, flight_name: str):
+    """
+    Rebuilds a feed on a background thread unless it is already being
+    rebuilt on this host. On failure the stale feed is left in place.
+    """
+    with _refreshing_lock:
+        if cache_key in _refreshing or is_refresh_backed_off(cache_key):
+            return
+        _refreshing.add(cache_key)
+
+    def run():
+        flight = SingleFlight(flight_name)
+        try:
+            if not flight.acquire(timeout=0):
+                return
+            feed = get_cache().get(cache_key)
+            if feed is not None and is_fresh(feed):
+                return
+            # Stale feeds are still being served, so they wait for users
+            with app.app_context(), rate_limit.lane(rate_limit.BACKGROUND):
+                with tmdb_api.track_failures() as failures:
+                    body = rebuild()
+                if failures:
+                    # Keep serving the stale feed rather than one without
+                    # TMDB data, and retry after the backoff
+                    record_refresh_failure(cache_key)
+                    return
+                store_feed(cache_key, body)
+        except Exception as error:  # pylint: disable=broad-except
+            record_refresh_failure(cache_key)
+            logger.exception(
+                {
+                    "message": "Failed to refresh stale feed",
+                    "info": {"cache_key": cache_key, "error": error},
+                }
+            )
+        finally:
+            flight.release()
+            with _refreshing_lock:
+                _refreshing.discard(cache_key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def is_refresh_backed_off(cache_key: str):
+    """
+    Returns whether the last background rebuild of the feed failed less than
+    FEED_REFRESH_BACKOFF seconds ago
+    """
+    with _refresh_failures_lock:
+        failed_at = _refresh_failures.get(cache_key)
+        if failed_at is None:
+            return False
+        if time.monotonic() - failed_at < FEED_REFRESH_BACKOFF:
+            return True
+        del _refresh_failures[cache_key]
+        return False
+
+
+def record_refresh_failure(cache_key: str):
+    """
+    Backs off background rebuilds of the feed
+    """
+    now = time.monotonic()
+    with _refresh_failures_lock:
+        # Drop failures that have expired, so the dict stays as small as the
+        # number of feeds currently failing
+        for key, failed_at in list(_refresh_failures.items()):
+            if now - failed_at >= FEED_REFRESH_BACKOFF:
+                del _refresh_failures[key]
+        _refresh_failures[cache_key] = now
+
+
+def stream_and_cache(
+    cache_key: str, chunks, flight: SingleFlight = None, cache: bool = True
+):
+    """
+    Yields chunks as they are produced and caches the full body once the
+    last one has been sent, unless cache is False, then releases the build
+    lock if one is held
+    """
+    parts = []
+    started = time.perf_counter()
+    for chunk in chunks:
+        parts.append(chunk)
+        yield chunk
+    metrics.observe_operation("render_ical", time.perf_counter() - started)
+    if cache:
+        store_feed(cache_key, "".join(parts))
+    if flight is not None:
+        flight.release()
+
+
+def conditional_response(response: Response, feed: dict):
+    """
+    Swaps in the stored variant of the feed that best matches the request's
+    Accept-Encoding, adds the feed's validators and turns the response into a
+    bodiless 304 when the request's If-None-Match / If-Modified-Since match
+    """
+    response.vary.add("Accept-Encoding")
+    variants = feed.get("encoded", {})
+    encoding = compression.choose_encoding(request.accept_encodings, variants)
+    etag = feed["etag"]
+    if encoding is not None:
+        response.set_data(variants[encoding])
+        response.content_encoding = encoding
+        # Each encoding is its own representation, so it needs its own ETag
+        etag = f"{etag}-{encoding}"
+    response.set_etag(etag)
+    response.last_modified = feed["last_modified"]
+    return response.make_conditional(request)
+
+
+def build_calendar(calendar_type: str, key: str, days_ago, period):
+    """
+    Returns a generator yielding the user's iCal feed. Raises ValueError for
+    an invalid window before anything is yielded.
+    """
+    trakt_access_token = get_token(key)
+    trakt_api = TraktAPI(
+        trakt_access_token["access_token"],
+        user_id=key,
+        generation=get_generation(key),
+    )
+    if calendar_type == "shows":
+        return trakt_api.iter_shows_calendar(days_ago=days_ago, period=period)
+    if calendar_type == "movies":
+        return trakt_api.iter_movies_calendar(days_ago=days_ago, period=period)
+    return trakt_api.iter_all_calendar(days_ago=days_ago, period=period)
+
+
+def render_calendar_body(calendar_type: str, key: str, days_ago, period):
+    """
+    Returns the user's whole iCal feed as a string
+    """
+    with metrics.track_operation("render_ical"):
+        chunks = build_calendar(calendar_type, key, days_ago, period)
+        with timing.phase("render"):
+            return "".join(chunks)
+
+
 @app.route("/<calendar_type>")
-@cache.cached(timeout=3600, query_string=["key", "days_ago", "period"])
 def calendar_ical(calendar_type):
     """
     Returns iCal file if key is provided, otherwise redirects to /auth.
 
     Args:
-        calendar_type (str): Type of calendar (shows/movies).
+        calendar_type (str): Type of calendar (shows/movies/all).
 
     Returns:
         Response: iCal file response.
@@ -252,9 +733,19 @@ def calendar_ical(calendar_type):
             },
         }
     )
-    if calendar_type not in ["shows", "movies"]:
+    if calendar_type not in CALENDAR_TYPES:
         return abort(404)
 
+    filename = f"trakt-calendar-{calendar_type}.ics"
+    key = clean_key(key)
+
+    def make_response(body):
+        response = Response(body, mimetype="text/calendar")
+        response.headers["Cache-Control"] = "max-age=3600"
+        response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+        response.vary.add("Accept-Encoding")
+        return response
+
     if not key:
         return """
         <html>
@@ -273,50 +764,328 @@ def calendar_ical(calendar_type):
         </html>
         """
 
-    period = int(period) if period else 90
+    try:
+        days_ago, period = get_window(days_ago, period)
+    except ValueError:
+        return {"error": "days_ago and period must be integers"}, 400
+    cache_key = get_feed_key("calendar_ical", key, calendar_type, days_ago, period)
+    flight_name = get_flight_name("calendar_ical", key, calendar_type, days_ago, period)
 
-    user = col.find_one({"user_id": key})
-    if not user:
+    feed = get_feed(
+        cache_key,
+        lambda: render_calendar_body(calendar_type, key, days_ago, period),
+        flight_name,
+    )
+    if feed is not None:
+        return conditional_response(make_response(feed["body"]), feed)
+
+    if get_token(key) is None:
         return redirect(url_for("authorize"))
-    trakt_access_token = get_token(key)
 
-    trakt_api = TraktAPI(trakt_access_token["access_token"])
+    # Only one request per feed builds it; the others wait here and are then
+    # answered from the cache. The builder holds the lock until the body is
+    # cached, or until its streamed response is closed if that comes first.
+    flight = SingleFlight(flight_name)
+    flight.acquire()
     try:
-        if calendar_type == "shows":
-            calendar = trakt_api.get_shows_calendar(
-                days_ago=days_ago,
-                period=period,
-            )
-            filename = "trakt-calendar-shows.ics"
-        elif calendar_type == "movies":
-            calendar = trakt_api.get_movies_calendar(
-                days_ago=days_ago,
-                period=period,
-            )
-            filename = "trakt-calendar-movies.ics"
-        else:
-            return "Invalid calendar type", 400
+        feed = get_cache().get(cache_key)
+        if feed is not None:
+            flight.release()
+            return conditional_response(make_response(feed["body"]), feed)
+        # The TMDB lookups run here, before the first chunk. A feed missing
+        # some of them is sent but not cached, so the next poll retries them.
+        with tmdb_api.track_failures() as failures:
+            chunks = build_calendar(calendar_type, key, days_ago, period)
     except ValueError as message:
+        flight.release()
         return {"error": str(message)}, 400
+    except BaseException:
+        flight.release()
+        raise
+
+    response = make_response(
+        stream_with_context(
+            stream_and_cache(cache_key, chunks, flight, cache=not failures)
+        )
+    )
+    response.call_on_close(flight.release)
+    return response
+
+
+# Preview item fields that come from TMDB; when none of them is requested the
+# lookups are skipped.
+TMDB_FIELDS = {"background", "logo", "network"}
+
+
+def get_preview_entries(calendar_type: str, key: str, days_ago: int, period: int):
+    """
+    Returns the user's calendar entries, episodes first
+    """
+    trakt_access_token = get_token(key)["access_token"]
+
+    trakt_api = TraktAPI(
+        trakt_access_token, user_id=key, generation=get_generation(key)
+    )
+
+    if calendar_type == "shows":
+        episodes, movies = trakt_api.get_shows_batch(days_ago, period), []
+    elif calendar_type == "movies":
+        episodes, movies = [], trakt_api.get_movies_batch(days_ago, period)
+    else:
+        episodes, movies = trakt_api.get_all_batch(days_ago, period)
+    return episodes + movies
+
+
+def group_preview_entries(entries):
+    """
+    Groups entries by day and returns (date_unix, entries) pairs sorted by
+    date
+    """
+    entries_by_date = {}
+    for entry in entries:
+        date_unix = entry.starts_at.timestamp()
+        date_unix = date_unix - (date_unix % 86400)
+        entries_by_date.setdefault(date_unix, []).append(entry)
+    return sorted(entries_by_date.items())
+
+
+def get_preview_lookups(entries, fields=None):
+    """
+    Returns the (kind, TMDB id) pairs the preview of entries needs looked up.
+    TV and movie ids overlap, so lookups are keyed by kind.
+    """
+    if fields is not None and not fields & TMDB_FIELDS:
+        return []
+    return [(entry.kind, entry.tmdb_id) for entry in entries if entry.tmdb_id]
+
+
+def enrich_preview_entries(calendar_type: str, entries, fields=None, summaries=None):
+    """
+    Returns the preview item of every entry, enriched with TMDB artwork and
+    networks and limited to fields if given
+    """
+
+    def get_backdrop(summary):
+        path = summary.get("backdrop_path")
+        return f"https://image.tmdb.org/t/p/w500{path}" if path else None
+
+    def get_logo(summary):
+        path = summary.get("logo_path")
+        return f"https://image.tmdb.org/t/p/original{path}" if path else None
+
+    # Look up every distinct TMDB id once, in parallel, before joining the
+    # results back onto the entries, unless the caller already did
+    if summaries is None:
+        tmdb = get_tmdb()
+        lookups = {"shows": tmdb.get_show_summary, "movies": tmdb.get_movie_summary}
+        summaries = tmdb.get_many(
+            lambda lookup: lookups[lookup[0]](lookup[1]),
+            get_preview_lookups(entries, fields),
+        )
+
+    items = []
+    for entry in entries:
+        summary = summaries.get((entry.kind, entry.tmdb_id), {})
+        if entry.kind == "shows":
+            entry_data = {
+                "airs_at": entry.starts_at,
+                "airs_at_unix": entry.starts_at.timestamp(),
+                "number": entry.number,
+                "overview": entry.overview,
+                "runtime": entry.runtime,
+                "season": entry.season,
+                "show": entry.show,
+                "title": entry.title,
+                "background": get_backdrop(summary),
+                "logo": get_logo(summary),
+                "ids": entry.ids,
+                "network": summary.get("network"),
+            }
+        else:
+            entry_data = {
+                "title": entry.title,
+                "overview": entry.overview,
+                "released": entry.released,
+                "released_unix": entry.starts_at.timestamp(),
+                "runtime": entry.runtime,
+                "background": get_backdrop(summary),
+                "logo": get_logo(summary),
+                "ids": entry.ids,
+            }
+        if calendar_type == "all":
+            entry_data["type"] = entry.kind
+        if fields is not None:
+            entry_data = {k: v for k, v in entry_data.items() if k in fields}
+        items.append(entry_data)
+    return items
+
+
+def make_day_group(date_unix: float, items):
+    """
+    Returns the preview object for one day
+    """
+    return {
+        "date_unix": date_unix,
+        "date_str": datetime.datetime.utcfromtimestamp(date_unix).strftime(
+            "%a, %d %b %Y %H:%M:%S GMT"
+        ),
+        "items": items,
+    }
+
+
+def build_calendar_preview(calendar_type: str, key: str, days_ago: int, period: int):
+    """
+    Returns the JSON preview body for the user's calendar, with entries
+    grouped by day and enriched with TMDB artwork and networks
+    """
+    with metrics.track_operation("render_preview"):
+        return _build_calendar_preview(calendar_type, key, days_ago, period)
+
+
+def _build_calendar_preview(calendar_type: str, key: str, days_ago: int, period: int):
+    groups = group_preview_entries(
+        get_preview_entries(calendar_type, key, days_ago, period)
+    )
+    return render_preview(
+        calendar_type,
+        groups,
+        enrich_preview_entries(
+            calendar_type, [entry for _, entries in groups for entry in entries]
+        ),
+    )
 
-    with tempfile.NamedTemporaryFile(mode="w", delete=False) as temp_file:
-        temp_file.write(calendar)
-        temp_file.flush()
-        temp_file.close()
 
-    path = os.path.join(os.path.dirname(__file__), temp_file.name)
-    string = open(path, "r", encoding="utf-8").read()
-    response = Response(string, mimetype="text/calendar")
-    response.headers["Cache-Control"] = "max-age=3600"
-    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+def render_preview(calendar_type: str, groups, items):
+    """
+    Returns the JSON preview body of the grouped entries, given the preview
+    items of all their entries in the same order
+    """
+    items = iter(items)
+    with timing.phase("render"):
+        sorted_entries = [
+            make_day_group(date_unix, [next(items) for _ in entries])
+            for date_unix, entries in groups
+        ]
+
+        # Prepare the final response
+        response_data = {
+            "type": calendar_type,
+            "data": sorted_entries,
+        }
+        return app.json.dumps(response_data)
+
+
+# Arguments that ask for a page of the preview rather than the cached whole
+PREVIEW_PAGE_ARGS = ("cursor", "limit", "fields", "format")
+
+
+def wants_ndjson(accept_mimetypes) -> bool:
+    """
+    Whether an Accept header prefers application/x-ndjson over JSON. A
+    wildcard such as */* matches both and so counts as JSON.
+    """
+    return (
+        accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+        == "application/x-ndjson"
+    )
+
+
+def is_page_request(args, accept_mimetypes) -> bool:
+    """
+    Whether a preview request asks for a page (or a stream) instead of the
+    full cached preview.
+    """
+    return any(args.get(arg) for arg in PREVIEW_PAGE_ARGS) or wants_ndjson(
+        accept_mimetypes
+    )
+
+
+def get_page(args):
+    """
+    Returns the cursor and limit arguments of a preview page, or None for
+    those not given. Raises ValueError unless limit is a positive integer
+    and cursor a finite number.
+    """
+    try:
+        cursor = float(args["cursor"]) if args.get("cursor") else None
+    except ValueError:
+        raise ValueError("cursor must be a number") from None
+    if cursor is not None and not math.isfinite(cursor):
+        raise ValueError("cursor must be a number")
+    try:
+        limit = int(args["limit"]) if args.get("limit") else None
+    except ValueError:
+        raise ValueError("limit must be an integer") from None
+    if limit is not None and limit < 1:
+        raise ValueError("limit must be at least 1")
+    return cursor, limit
+
+
+def preview_page_response(
+    calendar_type: str, key: str, days_ago: int, period: int, args
+):
+    """
+    Returns one page of the preview, starting at the day given by the cursor
+    argument and spanning at most limit days. Only the fields listed in the
+    fields argument are kept. With format=ndjson (or an Accept header asking
+    for application/x-ndjson) each day is streamed as its own line as soon as
+    it has been enriched.
+    """
+    cursor, limit = get_page(args)
+    fields = set(args["fields"].split(",")) if args.get("fields") else None
+    stream = args.get("format") == "ndjson" or wants_ndjson(request.accept_mimetypes)
+
+    groups = group_preview_entries(
+        get_preview_entries(calendar_type, key, days_ago, period)
+    )
+    if cursor is not None:
+        groups = [group for group in groups if group[0] >= cursor]
+    next_cursor = None
+    if limit is not None and len(groups) > limit:
+        next_cursor = groups[limit][0]
+        groups = groups[:limit]
+
+    if stream:
+
+        def lines():
+            # Days are enriched one at a time so the first line goes out
+            # without waiting on the whole page. An id seen on an earlier day
+            # is served from the shared TMDB cache.
+            for date_unix, entries in groups:
+                items = enrich_preview_entries(calendar_type, entries, fields)
+                yield app.json.dumps(make_day_group(date_unix, items)) + "\n"
+
+        response = Response(
+            stream_with_context(lines()), mimetype="application/x-ndjson"
+        )
+    else:
+        page_entries = [entry for _, entries in groups for entry in entries]
+        items = iter(enrich_preview_entries(calendar_type, page_entries, fields))
+        with timing.phase("render"):
+            body = app.json.dumps(
+                {
+                    "type": calendar_type,
+                    "data": [
+                        make_day_group(date_unix, [next(items) for _ in entries])
+                        for date_unix, entries in groups
+                    ],
+                    "next_cursor": next_cursor,
+                }
+            )
+        response = Response(body, mimetype="application/json")
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    response.headers.add("Access-Control-Allow-Origin", "*")
     return response
 
 
 @app.route("/<calendar_type>/json")
-@cache.cached(timeout=3600, query_string=["key", "days_ago", "period"])
 def get_calendar_preview(calendar_type):
     """
     Returns a JSON response with the calendar preview.
+
+    The full preview is cached. Passing cursor, limit, fields or format=ndjson
+    returns a page of it instead, built from the cached Trakt and TMDB data.
     """
     key = request.args.get("key")
     days_ago = request.args.get("days_ago")
@@ -333,135 +1102,91 @@ def get_calendar_preview(calendar_type):
         }
     )
 
-    if calendar_type not in ["shows", "movies"]:
+    if calendar_type not in CALENDAR_TYPES:
         return abort(404)
 
-    days_ago = int(days_ago) if days_ago else 30
-    period = int(period) if period else 90
-
+    key = clean_key(key)
     if not key:
         return "No key provided", 400
-    trakt_access_token = get_token(key)["access_token"]
-
-    trakt_api = TraktAPI(trakt_access_token)
+    try:
+        days_ago, period = get_window(days_ago, period)
+    except ValueError:
+        return {"error": "days_ago and period must be integers"}, 400
 
-    if calendar_type == "shows":
+    if is_page_request(request.args, request.accept_mimetypes):
         try:
-            entries = trakt_api.get_shows_batch(days_ago, period)
+            get_page(request.args)
         except ValueError as message:
             return {"error": str(message)}, 400
-    elif calendar_type == "movies":
+        if get_token(key) is None:
+            return abort(404)
         try:
-            entries = trakt_api.get_movies_batch(days_ago, period)
+            return preview_page_response(
+                calendar_type, key, days_ago, period, request.args
+            )
         except ValueError as message:
             return {"error": str(message)}, 400
-    else:
-        return "Invalid calendar type", 400
-
-    def get_backdrop(images):
-        try:
-            return f"https://image.tmdb.org/t/p/w500{images.get('backdrops')[0].get('file_path')}"
-        except Exception as error:
-            logger.exception(
-                {
-                    "message": "Failed to get logo",
-                    "info": {
-                        "images": images,
-                        "entry": entry,
-                        "error": error,
-                    },
-                }
-            )
-            return None
-
-    def get_logo(images):
-        try:
-            return f"https://image.tmdb.org/t/p/original{images.get('logos')[0].get('file_path')}"
-        except Exception as error:
-            logger.exception(
-                {
-                    "message": "Failed to get logo",
-                    "datetime": datetime.datetime.now(),
-                    "info": {
-                        "images": images,
-                        "entry": entry,
-                        "error": error,
-                    },
-                }
-            )
-            return None
 
-    # Separate the entries by their respective dates
-    entries_by_date = {}
-    for entry in entries:
-        if calendar_type == "shows":
-            show_ids = entry.show_data.__dict__.get("_ids")
-            images = tmdb.get_show_images(show_ids.get("tmdb"))
-            show_detail = tmdb.get_show(show_ids.get("tmdb"))
-            entry_data = {
-                "airs_at": entry.airs_at,
-                "airs_at_unix": entry.airs_at.timestamp(),
-                "number": entry.number,
-                "overview": entry.overview,
-                "runtime": entry.runtime,
-                "season": entry.season,
-                "show": entry.show,
-                "title": entry.title,
-                "background": get_backdrop(images),
-                "logo": get_logo(images),
-                "ids": show_ids,
-                "network": show_detail.get("networks")[0].get("name"),
-            }
-        elif calendar_type == "movies":
-            movie_ids = entry.__dict__.get("_ids")
-            images = tmdb.get_movie_images(movie_ids.get("tmdb"))
-
-            entry_data = {
-                "title": entry.title,
-                "overview": entry.overview,
-                "released": entry.released,
-                "released_unix": datetime.datetime.strptime(
-                    entry.released, "%Y-%m-%d"
-                ).timestamp(),
-                "runtime": entry.runtime,
-                "background": get_backdrop(images),
-                "logo": get_logo(images),
-                "ids": movie_ids,
-            }
-
-        date_unix = (
-            entry_data.get("airs_at_unix")
-            if calendar_type == "shows"
-            else entry_data.get("released_unix")
-        )
-
-        date_unix = date_unix - (date_unix % 86400)
-
-        date_str = datetime.datetime.utcfromtimestamp(date_unix).strftime(
-            "%a, %d %b %Y %H:%M:%S GMT"
-        )
+    cache_key = get_feed_key(
+        "get_calendar_preview", key, calendar_type, days_ago, period
+    )
+    flight_name = get_flight_name(
+        "get_calendar_preview", key, calendar_type, days_ago, period
+    )
+    feed = get_feed(
+        cache_key,
+        lambda: build_calendar_preview(calendar_type, key, days_ago, period),
+        flight_name,
+    )
+    if feed is None:
+        # The token is only needed for a build, so a cached preview is still
+        # served while Trakt can't refresh it
+        if get_token(key) is None:
+            return abort(404)
+        with SingleFlight(flight_name):
+            feed = get_cache().get(cache_key)
+            if feed is None:
+                try:
+                    with tmdb_api.track_failures() as failures:
+                        body = build_calendar_preview(
+                            calendar_type, key, days_ago, period
+                        )
+                except ValueError as message:
+                    return {"error": str(message)}, 400
+                feed = store_feed(cache_key, body, cache=not failures)
 
-        if date_unix not in entries_by_date:
-            entries_by_date[date_unix] = {
-                "date_unix": date_unix,
-                "date_str": date_str,
-                "items": [],
-            }
+    response = Response(feed["body"], mimetype="application/json")
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    return conditional_response(response, feed)
 
-        entries_by_date[date_unix]["items"].append(entry_data)
 
-    # Sort the entries by their respective dates
-    sorted_entries = sorted(entries_by_date.values(), key=lambda k: k["date_unix"])
+@app.errorhandler(rate_limit.RateLimited)
+def rate_limited(error):
+    """
+    Asks clients to come back once the upstream rate limit has reset, rather
+    than failing with a 500
+    """
+    logger.warning(
+        {
+            "message": "Upstream rate limited",
+            "info": {"path": request.path, "error": str(error)},
+        }
+    )
+    response = jsonify({"error": "Upstream is busy, try again later"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(max(1, int(error.retry_after + 0.5)))
+    return response
 
-    # Prepare the final response
-    response_data = {
-        "type": calendar_type,
-        "data": sorted_entries,
-    }
 
-    response = jsonify(response_data)
-    response.headers.add("Access-Control-Allow-Origin", "*")
-    return response
+@app.route("/metrics")
+def get_metrics():
+    """
+    Returns the Prometheus metrics of every worker, if METRICS_ENABLED is set
+    """
+    if not metrics.ENABLED:
+        return abort(404)
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
 
 
 @app.route("/api/user/<user_id>")
@@ -471,13 +1196,19 @@ def get_user(user_id):
     """
     if not user_id:
         return "No user ID provided", 400
-    user = col.find_one({"user_id": user_id})
-    if not user:
-        return abort(404)
-    else:
+    profile = profiles.get(user_id)
+    if profile is None:
+        with timing.phase("mongo"):
+            user = get_collection().find_one(
+                {"user_id": user_id}, {"user_slug": 1, "_id": 0}
+            )
+        if not user:
+            return abort(404)
         trakt_access_token = get_token(user_id)["access_token"]
         username = get_user_info(trakt_access_token)["user"]["username"]
-        return jsonify({"username": username, "slug": user["user_slug"]})
+        profile = {"username": username, "slug": user["user_slug"]}
+        profiles.set(user_id, profile)
+    return jsonify(profile)
 
 
 @app.route("/assets/<path:path>")
@@ -499,10 +1230,17 @@ def serve(host: str = "0.0.0.0", port: int = 8000, debug: bool = False):
     :param port: Port to run the app on
     :param debug: Enable debug mode
     """
+    ensure_secret_key()
+    app.run(host=host, port=port, debug=debug)
+
+
+def ensure_secret_key():
+    """
+    Generates SECRET_KEY and saves it to .env if it isn't set
+    """
     if "SECRET_KEY" not in os.environ:
         key = Fernet.generate_key()
         os.environ["SECRET_KEY"] = key.decode("utf-8")
         with open(".env", "a", encoding="utf-8") as file:
             file.write(f"\nSECRET_KEY={key.decode('utf-8')}")
     app.secret_key = os.environ["SECRET_KEY"]
-    app.run(host=host, port=port, debug=debug)
@@ -0,0 +1,105 @@
+"""
+Single-flight locks shared by the threads of a worker and by every worker on
+the host.
+
+Threads in one process queue on a regular lock; processes coordinate through
+an flock on a small file per lock name. The files are never removed, since
+unlinking a lock file that another process is about to open defeats the lock.
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+import time
+
+LOCK_DIR = os.environ.get("LOCK_DIR", "./cache/locks")
+
+# How long a caller waits for another builder before doing the work itself.
+LOCK_TIMEOUT = 60
+POLL_INTERVAL = 0.05
+
+_thread_locks = {}
+_registry_lock = threading.Lock()
+
+
+class SingleFlight:
+    """
+    An exclusive lock on name. Use as a context manager, or call acquire()
+    and release() when the lock has to outlive the current block (e.g. until
+    a streamed response is closed). release() is safe to call more than once.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        self.path = os.path.join(LOCK_DIR, f"{digest}.lock")
+        self._fd = None
+        self._thread_lock = None
+        self._state_lock = threading.Lock()
+
+    def acquire(self, timeout: float = LOCK_TIMEOUT):
+        """
+        Waits up to timeout seconds for the lock and returns whether it was
+        acquired. A timeout of 0 only tries once.
+        """
+        deadline = time.monotonic() + timeout
+        thread_lock = self._checkout()
+        if timeout > 0:
+            acquired = thread_lock.acquire(timeout=timeout)
+        else:
+            acquired = thread_lock.acquire(blocking=False)
+        if not acquired:
+            self._checkin()
+            return False
+        os.makedirs(LOCK_DIR, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    os.close(fd)
+                    thread_lock.release()
+                    self._checkin()
+                    return False
+                time.sleep(POLL_INTERVAL)
+        self._fd = fd
+        self._thread_lock = thread_lock
+        return True
+
+    def release(self):
+        """
+        Releases the lock if this instance holds it
+        """
+        with self._state_lock:
+            if self._fd is None:
+                return
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+            self._thread_lock.release()
+            self._thread_lock = None
+            self._checkin()
+
+    def _checkout(self):
+        with _registry_lock:
+            entry = _thread_locks.setdefault(self.name, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self):
+        with _registry_lock:
+            entry = _thread_locks.get(self.name)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del _thread_locks[self.name]
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
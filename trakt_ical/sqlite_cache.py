@@ -0,0 +1,203 @@
+"""
+A small SQLite-backed cache that is shared by every process on the host.
+
+Values are pickled and stored with an absolute expiry time. The table is kept
+below ``max_entries`` rows by evicting the least recently used keys, so the
+file can't grow without bound.
+"""
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Only refresh ``accessed_at`` on reads when it is older than this, so hot keys
+# don't turn every cache hit into a write.
+TOUCH_INTERVAL = 60
+
+# Check the row count every this many writes instead of on every write.
+PRUNE_INTERVAL = 64
+
+# What unpickling a corrupt entry, or one written by an incompatible version
+# of the code, can raise
+UNPICKLE_ERRORS = (
+    pickle.UnpicklingError,
+    AttributeError,
+    EOFError,
+    ImportError,
+    IndexError,
+)
+
+
+class SQLiteCache:
+    """
+    Process-safe key/value cache with per-key TTLs and LRU eviction. name
+    labels the cache's hits, misses and evictions in the metrics.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 10000,
+        default_timeout: int = 3600,
+        name: str = "sqlite",
+    ):
+        self.name = name
+        self.path = path
+        self.max_entries = max_entries
+        self.default_timeout = default_timeout
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def _conn(self):
+        """
+        Returns a connection for the current thread, reopening it after a fork
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value BLOB, expires_at REAL, accessed_at REAL)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)"
+        )
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str, default=None):
+        """
+        Returns the value stored under key, or default if it is missing or expired
+        """
+        value = self.get_blob(key)
+        if value is None:
+            return default
+        try:
+            return pickle.loads(value)
+        except UNPICKLE_ERRORS as error:
+            logger.warning(
+                {
+                    "message": "Failed to read from cache",
+                    "info": {"path": self.path, "key": key, "error": error},
+                }
+            )
+            # It would fail the same way on every read until evicted
+            self.delete(key)
+            return default
+
+    def get_blob(self, key: str):
+        """
+        Returns the pickled value stored under key, or None if it is missing
+        or expired
+        """
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, expires_at, accessed_at FROM cache WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                metrics.count_cache(self.name, "miss")
+                return None
+            value, expires_at, accessed_at = row
+            if expires_at <= now:
+                conn.execute(
+                    "DELETE FROM cache WHERE key = ? AND expires_at <= ?", (key, now)
+                )
+                metrics.count_cache(self.name, "expired")
+                return None
+            if now - accessed_at > TOUCH_INTERVAL:
+                conn.execute(
+                    "UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+            metrics.count_cache(self.name, "hit")
+            return value
+        except sqlite3.Error as error:
+            logger.warning(
+                {
+                    "message": "Failed to read from cache",
+                    "info": {"path": self.path, "key": key, "error": error},
+                }
+            )
+            return None
+
+    def set(self, key: str, value, timeout: int = None):
+        """
+        Stores value under key for timeout seconds
+        """
+        return self.set_blob(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), timeout)
+
+    def set_blob(self, key: str, value: bytes, timeout: int = None):
+        """
+        Stores an already pickled value under key for timeout seconds
+        """
+        now = time.time()
+        timeout = self.default_timeout if timeout is None else timeout
+        try:
+            conn = self._conn()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (key, value, now + timeout, now),
+            )
+            self._writes += 1
+            if self._writes % PRUNE_INTERVAL == 0:
+                self._prune(conn, now)
+            return True
+        except sqlite3.Error as error:
+            logger.warning(
+                {
+                    "message": "Failed to write to cache",
+                    "info": {"path": self.path, "key": key, "error": error},
+                }
+            )
+            return False
+
+    def delete(self, key: str):
+        """
+        Removes key from the cache
+        """
+        try:
+            self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+            return True
+        except sqlite3.Error:
+            return False
+
+    def clear(self):
+        """
+        Removes every entry from the cache
+        """
+        try:
+            self._conn().execute("DELETE FROM cache")
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _prune(self, conn, now: float):
+        """
+        Drops expired rows, then the least recently used rows above max_entries
+        """
+        expired = conn.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+        metrics.count_cache(self.name, "expired", expired.rowcount)
+        (count,) = conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self.max_entries:
+            evicted = conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed_at ASC LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            metrics.count_cache(self.name, "eviction", evicted.rowcount)
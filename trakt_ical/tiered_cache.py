@@ -0,0 +1,217 @@
+"""
+Two-tier cache backend for flask_caching.
+
+Each worker keeps recently used values in a byte-bounded in-memory LRU (L1)
+in front of an SQLite cache shared by every worker on the host (L2). L1
+entries live at most ``memory_ttl`` seconds, which bounds how long a worker
+can keep serving a value another worker replaced or deleted.
+
+Values in L1 are shared between requests and must not be mutated.
+"""
+
+import collections
+import logging
+import pickle
+import threading
+import time
+
+from flask_caching.backends.base import BaseCache
+
+import metrics
+from sqlite_cache import UNPICKLE_ERRORS, SQLiteCache
+
+logger = logging.getLogger(__name__)
+
+# Stand-in expiry for flask_caching's "never expires" timeout of 0.
+FOREVER = 10 * 365 * 86400
+
+_missing = object()
+
+
+class MemoryLRU:
+    """
+    Thread-safe LRU whose total size, as given by the caller, is bounded by
+    max_bytes. Entries expire after at most ttl seconds.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, name: str = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.name = name
+        self.size = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the value stored under key, or _missing
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return _missing
+            value, size, expires_at = item
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                return _missing
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, size: int, ttl: float = None):
+        """
+        Stores value, which takes size bytes, under key. Values larger than
+        the whole cache are not kept.
+        """
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._remove(key)
+            if size > self.max_bytes:
+                return
+            self._data[key] = (value, size, time.monotonic() + ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._data)))
+                if self.name:
+                    metrics.count_cache(self.name, "eviction")
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _remove(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self.size -= item[1]
+
+
+class TieredCache(BaseCache):
+    """
+    flask_caching backend with a per-process MemoryLRU in front of a shared
+    SQLiteCache. Configured through CACHE_SQLITE_PATH, CACHE_MAX_ENTRIES,
+    CACHE_MEMORY_MAX_BYTES and CACHE_MEMORY_TTL.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_entries: int = 100000,
+        memory_max_bytes: int = 64 * 1024 * 1024,
+        memory_ttl: float = 60,
+        default_timeout: int = 300,
+        name: str = "feeds",
+        **kwargs,
+    ):
+        super().__init__(default_timeout=default_timeout, **kwargs)
+        self.name = name
+        self.memory = MemoryLRU(memory_max_bytes, memory_ttl, name=f"{name}_memory")
+        self.disk = SQLiteCache(path, max_entries=max_entries, name=name)
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            path=config["CACHE_SQLITE_PATH"],
+            max_entries=config["CACHE_MAX_ENTRIES"],
+            memory_max_bytes=config["CACHE_MEMORY_MAX_BYTES"],
+            memory_ttl=config["CACHE_MEMORY_TTL"],
+        )
+        return cls(*args, **kwargs)
+
+    def get(self, key: str):
+        value, event = self._read(key)
+        self._count(event)
+        return None if value is _missing else value
+
+    def get_or_default(self, key: str, default):
+        """
+        Returns the value stored under key, or default if there is none,
+        without counting towards the hit and miss stats. A missing key is
+        remembered in L1 as default, so looking it up again within
+        memory_ttl doesn't go to SQLite.
+        """
+        value, _ = self._read(key)
+        if value is _missing:
+            size = len(pickle.dumps(default, pickle.HIGHEST_PROTOCOL))
+            self.memory.set(key, default, size)
+            return default
+        return value
+
+    def set(self, key: str, value, timeout: int = None):
+        timeout = self._get_timeout(timeout)
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.memory.set(key, value, len(blob), timeout)
+        return self.disk.set_blob(key, blob, timeout)
+
+    def add(self, key: str, value, timeout: int = None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+
+    def has(self, key: str):
+        return self.memory.get(key) is not _missing or (
+            self.disk.get_blob(key) is not None
+        )
+
+    def delete(self, key: str):
+        self.memory.delete(key)
+        return self.disk.delete(key)
+
+    def clear(self):
+        self.memory.clear()
+        return self.disk.clear()
+
+    def get_stats(self):
+        """
+        Returns this process's hit and miss counts and the size of its L1
+        """
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["memory_entries"] = len(self.memory)
+        stats["memory_bytes"] = self.memory.size
+        return stats
+
+    def _read(self, key: str):
+        """
+        Returns the value stored under key, or _missing, and whether it was a
+        memory_hit, disk_hit or miss
+        """
+        value = self.memory.get(key)
+        if value is not _missing:
+            return value, "memory_hit"
+        blob = self.disk.get_blob(key)
+        if blob is None:
+            return _missing, "miss"
+        try:
+            value = pickle.loads(blob)
+        except UNPICKLE_ERRORS as error:
+            logger.warning(
+                {
+                    "message": "Failed to read from cache",
+                    "info": {"path": self.disk.path, "key": key, "error": error},
+                }
+            )
+            # Treat it as a miss, so the entry is rebuilt and replaced
+            self.disk.delete(key)
+            return _missing, "miss"
+        self.memory.set(key, value, len(blob))
+        return value, "disk_hit"
+
+    def _get_timeout(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return FOREVER if timeout == 0 else timeout
+
+    def _count(self, event: str):
+        with self._stats_lock:
+            self.stats[event] += 1
+        metrics.count_cache(
+            f"{self.name}_memory", "hit" if event == "memory_hit" else "miss"
+        )
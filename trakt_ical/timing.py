@@ -0,0 +1,124 @@
+"""
+Per-request timing: phase durations sent back in a Server-Timing header, and
+an optional cProfile dump of requests slower than a threshold.
+
+Phases are recorded with ``with timing.phase("trakt"):`` anywhere on the
+request's thread; work done on pool threads is covered by the phase the
+request thread spends waiting on it. Repeated phases add up, and phases may
+nest (the "token" phase includes its "mongo" lookup).
+"""
+
+import contextlib
+import contextvars
+import cProfile
+import logging
+import os
+import re
+import time
+
+from flask import g, request
+
+logger = logging.getLogger(__name__)
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "1").lower() in ("1", "true", "yes")
+
+# Requests that take longer than this many milliseconds have their profile
+# written to PROFILE_DIR. Profiling every request has a real cost, so this is
+# off unless set.
+PROFILE_SLOW_REQUESTS_MS = float(os.environ.get("PROFILE_SLOW_REQUESTS_MS", "0"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "./cache/profiles")
+
+_phases = contextvars.ContextVar("phases", default=None)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    """
+    Adds the time spent in the block to the current request's name phase.
+    Outside of a request this does nothing.
+    """
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases[name] = phases.get(name, 0) + time.perf_counter() - started
+
+
+def format_header(phases: dict, total: float):
+    """
+    Returns a Server-Timing header value for phase durations in seconds
+    """
+    metrics = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items()]
+    metrics.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(metrics)
+
+
+def init_app(app):
+    """
+    Registers the request hooks that time and optionally profile requests
+    """
+
+    @app.before_request
+    def start_timing():
+        g.timing_started = time.perf_counter()
+        _phases.set({} if SERVER_TIMING else None)
+        if PROFILE_SLOW_REQUESTS_MS > 0:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another request on this process is already being profiled
+                return
+            g.profiler = profiler
+
+    @app.after_request
+    def finish_timing(response):
+        started = g.get("timing_started")
+        if started is None:
+            return response
+        phases = _phases.get()
+        if phases is not None:
+            response.headers["Server-Timing"] = format_header(
+                phases, time.perf_counter() - started
+            )
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            # Streamed bodies are rendered after this hook, so the profile is
+            # only stopped once the response has been sent
+            path = request.path
+            response.call_on_close(lambda: finish_profile(profiler, started, path))
+        return response
+
+    @app.teardown_request
+    def stop_profiler(error=None):
+        # Only left behind when the response hook didn't run
+        profiler = g.pop("profiler", None)
+        if profiler is not None:
+            profiler.disable()
+
+
+def finish_profile(profiler: cProfile.Profile, started: float, path: str):
+    """
+    Stops profiler and writes its stats to PROFILE_DIR if the request took
+    longer than PROFILE_SLOW_REQUESTS_MS
+    """
+    profiler.disable()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    if elapsed_ms < PROFILE_SLOW_REQUESTS_MS:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^a-zA-Z0-9]+", "_", path).strip("_") or "index"
+    filename = os.path.join(
+        PROFILE_DIR, f"{int(time.time() * 1000)}-{os.getpid()}-{name}.prof"
+    )
+    profiler.dump_stats(filename)
+    logger.warning(
+        {
+            "message": "Slow request profiled",
+            "info": {"path": path, "duration_ms": elapsed_ms, "profile": filename},
+        }
+    )
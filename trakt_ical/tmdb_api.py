@@ -1,31 +1,247 @@
+import concurrent.futures
+import contextlib
+import contextvars
+import logging
 import os
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import rate_limit
+import timing
+from sqlite_cache import SQLiteCache
+
+logger = logging.getLogger(__name__)
+
+# How long each kind of TMDB response is cached for, in seconds. Network names
+# and artwork almost never change once a show or movie is listed.
+CACHE_TTLS = {
+    "tv": 7 * 86400,
+    "tv_images": 7 * 86400,
+    "movie": 7 * 86400,
+    "movie_images": 7 * 86400,
+    "tv_summary": 7 * 86400,
+    "movie_summary": 7 * 86400,
+}
+NOT_FOUND_TTL = 3600
+
+TMDB_API_URL = os.getenv("TMDB_API_URL", "https://api.themoviedb.org/3")
+
+# Image languages requested alongside summaries; "null" matches textless art.
+IMAGE_LANGUAGES = os.getenv("TMDB_IMAGE_LANGUAGES", "en,null")
+
+# Upper bound on concurrent TMDB requests per process.
+MAX_CONCURRENCY = int(os.getenv("TMDB_MAX_CONCURRENCY", "8"))
+
+# Ids of the failed lookups of the current build, see track_failures()
+_failures = contextvars.ContextVar("tmdb_failures", default=None)
+
+_cache = None
+_session = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Returns the TMDB response cache shared by every worker on this host
+    """
+    global _cache
+    if _cache is None:
+        _cache = SQLiteCache(
+            os.getenv("TMDB_CACHE_PATH", "./cache/tmdb.sqlite3"),
+            max_entries=int(os.getenv("TMDB_CACHE_MAX_ENTRIES", "20000")),
+            name="tmdb",
+        )
+    return _cache
+
+
+def get_session():
+    """
+    Returns the keep-alive session used for every TMDB request in this process
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=1, pool_maxsize=MAX_CONCURRENCY, max_retries=1
+            )
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return _session
+
+
+def get_executor():
+    """
+    Returns the thread pool that bounds concurrent TMDB lookups in this process
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_CONCURRENCY, thread_name_prefix="tmdb"
+            )
+    return _executor
+
+
+@contextlib.contextmanager
+def track_failures():
+    """
+    Yields a list that collects the ids of the lookups get_many() gives up
+    on inside the block, so a feed built without them isn't cached
+    """
+    failures = []
+    token = _failures.set(failures)
+    try:
+        yield failures
+    finally:
+        _failures.reset(token)
+
+
+def record_failure(tmdb_id):
+    """
+    Adds a failed lookup to the list of the enclosing track_failures()
+    """
+    failures = _failures.get()
+    if failures is not None:
+        failures.append(tmdb_id)
 
 
 class TMDB:
-    def __init__(self):
+    def __init__(self, cache=None):
         self.access_token = os.getenv("TMDB_ACCESS_TOKEN")
-        self.base_url = "https://api.themoviedb.org/3"
+        self.base_url = TMDB_API_URL
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.access_token}",
         }
+        self.cache = cache if cache is not None else get_cache()
+
+    def _req(self, method: str, url: str, endpoint: str = "other", **kwargs):
+        return rate_limit.send(
+            "tmdb",
+            get_session(),
+            method,
+            url,
+            endpoint,
+            headers=self.headers,
+            timeout=10,
+            **kwargs,
+        )
+
+    def get_many(self, fetch, ids):
+        """
+        Calls fetch once per distinct, non-empty id in ids, in parallel.
+
+        Returns a dict mapping each id to its result. Lookups that fail are
+        logged and mapped to an empty dict so one bad id can't sink a feed.
+        """
+        unique_ids = list(dict.fromkeys(i for i in ids if i))
+        results = {}
+        with timing.phase("tmdb"):
+            fetch = rate_limit.bind(fetch)
+            futures = {i: get_executor().submit(fetch, i) for i in unique_ids}
+            for tmdb_id, future in futures.items():
+                try:
+                    results[tmdb_id] = future.result()
+                except (requests.RequestException, ValueError) as error:
+                    logger.warning(
+                        {
+                            "message": "TMDB lookup failed",
+                            "info": {"id": tmdb_id, "error": error},
+                        }
+                    )
+                    record_failure(tmdb_id)
+                    results[tmdb_id] = {}
+        return results
+
+    def _get_cached(self, endpoint: str, url: str, params=None, trim=None):
+        key = self._cache_key(url, params)
+        data = self.cache.get(key)
+        if data is not None:
+            return data
+        response = self._req("GET", url, endpoint=endpoint, params=params)
+        return self._store(endpoint, key, response.status_code, response.json(), trim)
+
+    @staticmethod
+    def _cache_key(url: str, params=None):
+        key = f"tmdb:{url}"
+        if params:
+            key += "?" + "&".join(f"{k}={v}" for k, v in sorted(params.items()))
+        return key
 
-    def _req(self, method: str, url: str, **kwargs):
-        return requests.request(method, url, headers=self.headers, **kwargs, timeout=10)
+    def _store(self, endpoint: str, key: str, status: int, data, trim=None):
+        """
+        Caches a response's data, trimmed, and returns it. A 404 is cached as
+        an empty result; any other error raises HTTPError, as its body isn't
+        a result.
+        """
+        if status == 200:
+            if trim:
+                data = trim(data)
+            self.cache.set(key, data, CACHE_TTLS[endpoint])
+        elif status == 404:
+            if trim:
+                data = trim({})
+            self.cache.set(key, data, NOT_FOUND_TTL)
+        else:
+            raise requests.HTTPError(f"TMDB {endpoint} returned {status}")
+        return data
 
     def get_show_images(self, show_id: int):
         url = f"{self.base_url}/tv/{show_id}/images"
-        return self._req("GET", url).json()
+        return self._get_cached("tv_images", url)
 
     def get_movie_images(self, movie_id: int):
         url = f"{self.base_url}/movie/{movie_id}/images"
-        return self._req("GET", url).json()
+        return self._get_cached("movie_images", url)
 
     def get_movie(self, movie_id: int):
         url = f"{self.base_url}/movie/{movie_id}"
-        return self._req("GET", url).json()
+        return self._get_cached("movie", url)
 
     def get_show(self, show_id: int):
         url = f"{self.base_url}/tv/{show_id}"
-        return self._req("GET", url).json()
+        return self._get_cached("tv", url)
+
+    def get_show_summary(self, show_id: int):
+        """
+        Returns the network, backdrop and logo of a show in a single request
+        """
+        url = f"{self.base_url}/tv/{show_id}"
+        return self._get_cached(
+            "tv_summary", url, self._summary_params(), self._trim_summary
+        )
+
+    def get_movie_summary(self, movie_id: int):
+        """
+        Returns the backdrop and logo of a movie in a single request
+        """
+        url = f"{self.base_url}/movie/{movie_id}"
+        return self._get_cached(
+            "movie_summary", url, self._summary_params(), self._trim_summary
+        )
+
+    @staticmethod
+    def _summary_params():
+        return {
+            "append_to_response": "images",
+            "include_image_language": IMAGE_LANGUAGES,
+        }
+
+    @staticmethod
+    def _trim_summary(data: dict):
+        """
+        Keeps only the fields the calendar and preview use
+        """
+        networks = data.get("networks") or [{}]
+        images = data.get("images") or {}
+        backdrops = images.get("backdrops") or [{}]
+        logos = images.get("logos") or [{}]
+        return {
+            "network": networks[0].get("name"),
+            "backdrop_path": backdrops[0].get("file_path"),
+            "logo_path": logos[0].get("file_path"),
+        }
@@ -4,150 +4,299 @@ Module for interacting with the Trakt API
 
 import concurrent.futures
 import datetime
+import heapq
 import os
+import threading
 
-import trakt
-import trakt.core
-from icalendar import Calendar, Event
+import requests
+from requests.adapters import HTTPAdapter
 from trakt.calendar import MyMovieCalendar, MyShowCalendar
+import rate_limit
+import timing
+from calendar_entry import CalendarEntry
+from ical_writer import render_calendar
+from sqlite_cache import SQLiteCache
 from tmdb_api import TMDB
 
 APPLICATION_ID = os.environ.get("TRAKT_APPLICATION_ID")
 CLIENT_ID = os.environ.get("TRAKT_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("TRAKT_CLIENT_SECRET")
 
+TRAKT_API_URL = os.environ.get("TRAKT_API_URL", "https://api.trakt.tv")
+
 MAX_DAYS_AGO = 30
 MAX_PERIOD = 90
 
+# Upper bound on concurrent Trakt calendar requests per process.
+MAX_WORKERS = int(os.environ.get("TRAKT_MAX_WORKERS", "4"))
+
+# Calendar results are cached per user in fixed, epoch-aligned date buckets so a
+# sliding window only has to fetch the buckets that are missing or expired. A
+# bucket must fit in a single Trakt calendar call (at most 33 days).
+BUCKET_DAYS = 30
+PAST_BUCKET_TTL = 3 * 86400
+CURRENT_BUCKET_TTL = 3600
+FUTURE_BUCKET_TTL = 6 * 3600
+
+# The calendar class of each kind and how its items are normalized. Movies
+# without a release date can't be placed on a calendar and are dropped.
+CALENDARS = {
+    "shows": (MyShowCalendar, CalendarEntry.from_episode),
+    "movies": (
+        MyMovieCalendar,
+        lambda movie: CalendarEntry.from_movie(movie) if movie.released else None,
+    ),
+}
+
+_bucket_cache = None
+_session = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_bucket_cache():
+    """
+    Returns the calendar bucket cache shared by every worker on this host
+    """
+    global _bucket_cache
+    if _bucket_cache is None:
+        _bucket_cache = SQLiteCache(
+            os.environ.get("TRAKT_CACHE_PATH", "./cache/trakt.sqlite3"),
+            max_entries=int(os.environ.get("TRAKT_CACHE_MAX_ENTRIES", "50000")),
+            name="trakt",
+        )
+    return _bucket_cache
+
+
+def get_session():
+    """
+    Returns the keep-alive session used for every Trakt request in this process
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+    return _session
+
+
+def get_executor():
+    """
+    Returns the thread pool that bounds concurrent Trakt requests in this process
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_WORKERS, thread_name_prefix="trakt"
+            )
+    return _executor
+
+
+def get_buckets(start: datetime.date, end: datetime.date):
+    """
+    Returns the start dates of the buckets covering start..end (exclusive)
+    """
+    first = start.toordinal() // BUCKET_DAYS
+    last = (end.toordinal() - 1) // BUCKET_DAYS
+    return [
+        datetime.date.fromordinal(index * BUCKET_DAYS)
+        for index in range(first, last + 1)
+    ]
+
+
+def get_bucket_ttl(bucket_start: datetime.date, today: datetime.date):
+    """
+    Returns how long a bucket stays cached: buckets in the past rarely change,
+    while the one containing today and the next one change often
+    """
+    bucket_end = bucket_start + datetime.timedelta(days=BUCKET_DAYS)
+    if bucket_end <= today:
+        return PAST_BUCKET_TTL
+    if bucket_start <= today + datetime.timedelta(days=BUCKET_DAYS):
+        return CURRENT_BUCKET_TTL
+    return FUTURE_BUCKET_TTL
+
+
+def get_calendar_url(kind: str, start_date: datetime.date):
+    """
+    Returns the URL of one bucket of the kind's calendar
+    """
+    calendar_cls = CALENDARS[kind][0]
+    return f"{TRAKT_API_URL}/{calendar_cls.url}/{start_date.isoformat()}/{BUCKET_DAYS}"
+
+
+def parse_calendar(kind: str, data):
+    """
+    Parses a calendar response with pytrakt's own parser and returns its
+    items as normalized entries
+    """
+    calendar_cls, normalize = CALENDARS[kind]
+    calendar = calendar_cls.__new__(calendar_cls)
+    calendar._build(data)
+    entries = (normalize(item) for item in calendar)
+    return [entry for entry in entries if entry is not None]
+
 
 class TraktAPI:
     """
     Class for interacting with the Trakt API
     """
 
-    def __init__(self, oauth_token=None):
+    def __init__(self, oauth_token=None, user_id: str = None, generation: int = 0):
         self.client_id = os.environ.get("TRAKT_CLIENT_ID")
         self.client_secret = os.environ.get("TRAKT_CLIENT_SECRET")
         self.oauth_token = oauth_token
-        trakt.core.CLIENT_ID = self.client_id
-        trakt.core.CLIENT_SECRET = self.client_secret
+        self.user_id = user_id
+        # Cached buckets are keyed by the user's cache generation, so bumping
+        # it drops them along with the user's feeds
+        self.cache_prefix = f"entries:{user_id}:{generation}"
+        # Credentials are sent per request rather than through trakt.core's
+        # module globals, so concurrent users in one worker can't mix them up
+        self.headers = {
+            "Content-Type": "application/json",
+            "trakt-api-version": "2",
+            "trakt-api-key": self.client_id,
+        }
         if oauth_token:
-            trakt.core.OAUTH_TOKEN = oauth_token
+            self.headers["Authorization"] = f"Bearer {oauth_token}"
         self.tmdb = TMDB()
 
     def get_shows_batch(self, days_ago: int, period: int):
         """
-        Returns the episodes for the given start date and days
+        Returns the episodes for the given start date and days as
+        CalendarEntry records
         """
-        episodes = []
-        if days_ago > MAX_DAYS_AGO or period > MAX_PERIOD:
-            raise ValueError(
-                f"days_ago must be less than {MAX_DAYS_AGO} and period must be less than {MAX_PERIOD}"
-            )
+        return self._get_windows(["shows"], days_ago, period)["shows"]
 
-        def get_episodes(start_date, days):
-            print(start_date, days)
-            return MyShowCalendar(
-                days=days,
-                extended="full",
-                date=start_date,
-            )
+    def get_movies_batch(self, days_ago: int, period: int):
+        """
+        Returns the movies for the given start date and days as CalendarEntry
+        records
+        """
+        return self._get_windows(["movies"], days_ago, period)["movies"]
 
-        start_date = (
-            datetime.datetime.now() - datetime.timedelta(days=days_ago)
-        ).strftime("%Y-%m-%d")
-        end_date = (datetime.datetime.now() + datetime.timedelta(days=period)).strftime(
-            "%Y-%m-%d"
-        )
+    def get_all_batch(self, days_ago: int, period: int):
+        """
+        Returns the episodes and the movies for the given start date and days,
+        fetched at the same time
+        """
+        windows = self._get_windows(["shows", "movies"], days_ago, period)
+        return windows["shows"], windows["movies"]
 
-        if (
-            datetime.datetime.strptime(end_date, "%Y-%m-%d")
-            - datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        ).days < 33:
-            episodes = get_episodes(start_date, period)
-        else:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = []
-                batch_start_date = start_date
-                while (
-                    datetime.datetime.strptime(end_date, "%Y-%m-%d")
-                    - datetime.datetime.strptime(batch_start_date, "%Y-%m-%d")
-                ).days > 33:
-                    futures.append(executor.submit(get_episodes, batch_start_date, 33))
-                    batch_start_date = (
-                        datetime.datetime.strptime(batch_start_date, "%Y-%m-%d")
-                        + datetime.timedelta(days=33)
-                    ).strftime("%Y-%m-%d")
-                futures.append(
-                    executor.submit(
-                        get_episodes,
-                        batch_start_date,
-                        (
-                            datetime.datetime.strptime(end_date, "%Y-%m-%d")
-                            - datetime.datetime.strptime(batch_start_date, "%Y-%m-%d")
-                        ).days,
-                    )
-                )
-                for future in concurrent.futures.as_completed(futures):
-                    episodes += future.result()
-        return episodes
+    def _get_windows(self, kinds, days_ago: int, period: int):
+        """
+        Returns a dict mapping each kind to its calendar items dated from
+        days_ago days ago up to period days from now
+        """
+        today, start, end = self._get_range(days_ago, period)
+        with timing.phase("trakt"):
+            windows = self._get_bucketed(kinds, start, end, today)
+        return self._trim_windows(windows, start, end)
 
-    def get_movies_batch(self, days_ago: int, period: int):
+    @staticmethod
+    def _get_range(days_ago: int, period: int):
         """
-        Returns the movies for the given start date and days
+        Returns today and the start and (exclusive) end dates of a window
         """
-        movies = []
         if days_ago > MAX_DAYS_AGO or period > MAX_PERIOD:
             raise ValueError(
                 f"days_ago must be less than {MAX_DAYS_AGO} and period must be less than {MAX_PERIOD}"
             )
+        today = datetime.datetime.now().date()
+        start = today - datetime.timedelta(days=days_ago)
+        end = today + datetime.timedelta(days=period)
+        return today, start, end
+
+    @staticmethod
+    def _trim_windows(windows: dict, start, end):
+        """
+        Drops the entries of whole buckets that fall outside start..end
+        """
+        for kind, entries in windows.items():
+            windows[kind] = [
+                entry for entry in entries if start <= entry.starts_at.date() < end
+            ]
+        return windows
+
+    def _get_bucketed(self, kinds, start, end, today):
+        """
+        Returns a dict mapping each kind to every calendar item in the buckets
+        covering start..end.
+
+        Buckets are read from the shared cache when this API is bound to a
+        user; only the missing or expired ones are fetched from Trakt, all
+        at once on the shared pool.
+        """
+        buckets = get_buckets(start, end)
+        results, missing = self._read_buckets(kinds, buckets)
+        fetch = rate_limit.bind(self._fetch_calendar)
+        futures = [
+            get_executor().submit(fetch, kind, bucket_start)
+            for kind, bucket_start in missing
+        ]
+        for (kind, bucket_start), future in zip(missing, futures):
+            results[kind, bucket_start] = future.result()
+            self._store_bucket(kind, bucket_start, results[kind, bucket_start], today)
+        return self._join_buckets(kinds, buckets, results)
+
+    def _read_buckets(self, kinds, buckets):
+        """
+        Returns the cached buckets, keyed by (kind, bucket start), and the
+        keys of the ones that have to be fetched
+        """
+        results = {}
+        if self.user_id:
+            cache = get_bucket_cache()
+            for kind in kinds:
+                for bucket_start in buckets:
+                    items = cache.get(f"{self.cache_prefix}:{kind}:{bucket_start}")
+                    if items is not None:
+                        results[kind, bucket_start] = items
+        missing = [
+            (kind, bucket_start)
+            for kind in kinds
+            for bucket_start in buckets
+            if (kind, bucket_start) not in results
+        ]
+        return results, missing
 
-        def get_movies(start_date, days):
-            print(start_date, days)
-            return MyMovieCalendar(
-                days=days,
-                extended="full",
-                date=start_date,
+    def _store_bucket(self, kind: str, bucket_start, items, today):
+        if self.user_id:
+            get_bucket_cache().set(
+                f"{self.cache_prefix}:{kind}:{bucket_start}",
+                items,
+                get_bucket_ttl(bucket_start, today),
             )
 
-        start_date = (
-            datetime.datetime.now() - datetime.timedelta(days=days_ago)
-        ).strftime("%Y-%m-%d")
-        end_date = (datetime.datetime.now() + datetime.timedelta(days=period)).strftime(
-            "%Y-%m-%d"
-        )
+    @staticmethod
+    def _join_buckets(kinds, buckets, results):
+        windows = {}
+        for kind in kinds:
+            windows[kind] = []
+            for bucket_start in buckets:
+                windows[kind] += results[kind, bucket_start]
+        return windows
 
-        if (
-            datetime.datetime.strptime(end_date, "%Y-%m-%d")
-            - datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        ).days < 33:
-            movies = get_movies(start_date, period)
-        else:
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                futures = []
-                batch_start_date = start_date
-                while (
-                    datetime.datetime.strptime(end_date, "%Y-%m-%d")
-                    - datetime.datetime.strptime(batch_start_date, "%Y-%m-%d")
-                ).days > 33:
-                    futures.append(executor.submit(get_movies, batch_start_date, 33))
-                    batch_start_date = (
-                        datetime.datetime.strptime(batch_start_date, "%Y-%m-%d")
-                        + datetime.timedelta(days=33)
-                    ).strftime("%Y-%m-%d")
-                futures.append(
-                    executor.submit(
-                        get_movies,
-                        batch_start_date,
-                        (
-                            datetime.datetime.strptime(end_date, "%Y-%m-%d")
-                            - datetime.datetime.strptime(batch_start_date, "%Y-%m-%d")
-                        ).days,
-                    )
-                )
-                for future in concurrent.futures.as_completed(futures):
-                    movies += future.result()
-        return movies
+    def _fetch_calendar(self, kind: str, start_date: datetime.date):
+        """
+        Fetches one bucket of the kind's calendar from Trakt, parses it with
+        pytrakt's own parser and returns it as normalized entries
+        """
+        response = rate_limit.send(
+            "trakt",
+            get_session(),
+            "GET",
+            get_calendar_url(kind, start_date),
+            f"calendar_{kind}",
+            headers=self.headers,
+            params={"extended": "full"},
+            timeout=10,
+        )
+        response.raise_for_status()
+        return parse_calendar(kind, response.json())
 
     def get_shows_calendar(
         self,
@@ -162,40 +311,29 @@ class TraktAPI:
             days_ago (int): days ago to start the calendar. Defaults to None.
             period (int, optional): The number of days to include in the calendar. Defaults to 365.
         """
+        return "".join(self.iter_shows_calendar(days_ago, period))
 
-        days_ago = int(days_ago) if days_ago else 30
-        period = int(period) if period else 90
+    def iter_shows_calendar(
+        self,
+        days_ago: int = 30,
+        period: int = 90,
+    ):
+        """
+        Fetches and enriches the episodes, then returns a generator yielding
+        the iCal calendar one event at a time
+
+        Args:
+            days_ago (int): days ago to start the calendar. Defaults to 30.
+            period (int, optional): The number of days to include in the calendar. Defaults to 90.
+        """
 
         episodes = self.get_shows_batch(days_ago, period)
 
-        cal = Calendar()
-        cal.add("prodid", "-//Trakt//trakt_ical//EN")
-        cal.add("version", f"{datetime.datetime.now().strftime('%Y%m%d %H:%M')}")
+        summaries = self.tmdb.get_many(
+            self.tmdb.get_show_summary, [episode.tmdb_id for episode in episodes]
+        )
 
-        for episode in episodes:
-            if episode.runtime is None or episode.runtime == 0:
-                episode.runtime = 30
-            show_ids = episode.show_data.__dict__.get("_ids")
-            show_detail = self.tmdb.get_show(show_ids.get("tmdb"))
-            summary = f"{episode.show} - S{episode.season:02d}E{episode.number:02d}"
-            event = Event()
-            event.add("summary", summary)
-            event.add("dtstart", episode.airs_at)
-            event.add(
-                "dtend",
-                episode.airs_at + datetime.timedelta(minutes=episode.show_data.runtime),
-            )
-            event.add("dtstamp", datetime.datetime.now())
-            event.add("uid", f"{episode.show}-{episode.season}-{episode.number}")
-            overview = episode.overview
-            if overview:
-                event.add("description", episode.title + "\n" + overview)
-            else:
-                event.add("description", episode.title)
-            if show_detail.get("networks")[0].get("name"):
-                event.add("location", show_detail.get("networks")[0].get("name"))
-            cal.add_component(event)
-        return cal.to_ical().decode("utf-8")
+        return self.render(episodes, [], summaries)
 
     def get_movies_calendar(
         self,
@@ -210,33 +348,123 @@ class TraktAPI:
             days_ago (int): days ago to start the calendar. Defaults to None.
             period (int, optional): The number of days to include in the calendar. Defaults to 365.
         """
+        return "".join(self.iter_movies_calendar(days_ago, period))
+
+    def iter_movies_calendar(
+        self,
+        days_ago: int = 30,
+        period: int = 90,
+    ):
+        """
+        Fetches the movies, then returns a generator yielding the iCal
+        calendar one event at a time
 
-        days_ago = int(days_ago) if days_ago else 30
-        period = int(period) if period else 90
+        Args:
+            days_ago (int): days ago to start the calendar. Defaults to 30.
+            period (int, optional): The number of days to include in the calendar. Defaults to 90.
+        """
 
         movies = self.get_movies_batch(days_ago, period)
 
-        cal = Calendar()
-        cal.add("prodid", "-//Trakt//trakt_ical//EN")
-        cal.add("version", f"{datetime.datetime.now().strftime('%Y%m%d %H:%M')}")
+        return self.render([], movies, {})
+
+    def get_all_calendar(
+        self,
+        days_ago: int = 30,
+        period: int = 90,
+    ):
+        """
+        Returns the combined shows and movies calendar in iCal format
 
+        Returns:
+            str: iCal calendar
+        """
+        return "".join(self.iter_all_calendar(days_ago, period))
+
+    def iter_all_calendar(
+        self,
+        days_ago: int = 30,
+        period: int = 90,
+    ):
+        """
+        Fetches the episodes and movies at the same time, enriches the
+        episodes, then returns a generator yielding both in date order
+
+        Args:
+            days_ago (int): days ago to start the calendar. Defaults to 30.
+            period (int, optional): The number of days to include in the calendar. Defaults to 90.
+        """
+
+        episodes, movies = self.get_all_batch(days_ago, period)
+
+        summaries = self.tmdb.get_many(
+            self.tmdb.get_show_summary, [episode.tmdb_id for episode in episodes]
+        )
+
+        return self.render(episodes, movies, summaries)
+
+    def render(self, episodes, movies, summaries):
+        """
+        Returns a generator yielding the iCal calendar of the episodes, with
+        their TMDB summaries, and the movies, in date order
+        """
+        # Both windows are already in date order, so merging keeps them sorted
+        events = heapq.merge(
+            self._show_events(episodes, summaries),
+            self._movie_events(movies),
+            key=lambda event: event["dtstart"],
+        )
+        return render_calendar(self._calendar_properties(), events)
+
+    @staticmethod
+    def _show_events(episodes, summaries):
+        """
+        Yields the iCal event properties for each episode
+        """
+        for episode in episodes:
+            yield {
+                "summary": f"{episode.show} - S{episode.season:02d}E{episode.number:02d}",
+                "dtstart": episode.starts_at,
+                "dtend": episode.starts_at
+                + datetime.timedelta(minutes=episode.runtime or 30),
+                "dtstamp": episode.starts_at,
+                "uid": (
+                    f"episode-{episode.trakt_id}@trakt-ical"
+                    if episode.trakt_id
+                    else f"{episode.show}-{episode.season}-{episode.number}"
+                ),
+                "description": (
+                    episode.title + "\n" + episode.overview
+                    if episode.overview
+                    else episode.title
+                ),
+                "location": summaries.get(episode.tmdb_id, {}).get("network"),
+            }
+
+    @staticmethod
+    def _movie_events(movies):
+        """
+        Yields the iCal event properties for each movie
+        """
         for movie in movies:
-            year = datetime.datetime.strptime(movie.released, "%Y-%m-%d").year
-            summary = f"{movie.title} ({year})"
-            event = Event()
-            event.add("summary", summary)
-            event.add("dtstart", datetime.datetime.strptime(movie.released, "%Y-%m-%d"))
-            event.add(
-                "dtend",
-                datetime.datetime.strptime(movie.released, "%Y-%m-%d")
-                + datetime.timedelta(hours=2),
-            )
-            event.add("dtstamp", datetime.datetime.now())
-            event.add("uid", f"{movie.title}-{movie.released}")
-            overview = movie.overview
-            if overview:
-                event.add("description", overview)
-            else:
-                event.add("description", movie.title)
-            cal.add_component(event)
-        return cal.to_ical().decode("utf-8")
+            yield {
+                "summary": f"{movie.title} ({movie.starts_at.year})",
+                "dtstart": movie.starts_at,
+                "dtend": movie.starts_at + datetime.timedelta(hours=2),
+                "dtstamp": movie.starts_at,
+                "uid": (
+                    f"movie-{movie.trakt_id}-{movie.released}@trakt-ical"
+                    if movie.trakt_id
+                    else f"{movie.title}-{movie.released}"
+                ),
+                "description": movie.overview or movie.title,
+            }
+
+    @staticmethod
+    def _calendar_properties():
+        # Nothing here may depend on the current time: identical data must
+        # render to an identical body so ETags stay stable between builds
+        return {
+            "prodid": "-//Trakt//trakt_ical//EN",
+            "version": "2.0",
+        }
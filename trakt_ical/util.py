@@ -1,8 +1,14 @@
 from cryptography.fernet import Fernet
+import collections
+import functools
 import os
+import threading
+import time
 from dotenv import load_dotenv
 import json
 
+import metrics
+
 load_dotenv(override=True)
 
 
@@ -20,13 +26,61 @@ def encrypt(data):
     return fernet.encrypt(data.encode())
 
 
-def decrypt(data):
-    key = os.environ.get("SECRET_KEY")
-    key = bytes(key, "utf-8")
+@functools.lru_cache(maxsize=4)
+def get_fernet(key: str):
+    return Fernet(bytes(key, "utf-8"))
 
-    fernet = Fernet(key)
+
+def decrypt(data):
+    fernet = get_fernet(os.environ.get("SECRET_KEY"))
     decrypted_data = fernet.decrypt(data).decode()
 
     if decrypted_data.startswith("{"):
         decrypted_data = json.loads(decrypted_data)
     return decrypted_data
+
+
+class TTLCache:
+    """
+    Small thread-safe LRU mapping whose entries expire after ttl seconds. If
+    name is given, hits, misses and evictions are counted in the metrics.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300, name: str = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self._count("miss")
+                return default
+            value, expires_at = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._count("expired")
+                return default
+            self._data.move_to_end(key)
+            self._count("hit")
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._count("eviction")
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def _count(self, event: str):
+        if self.name:
+            metrics.count_cache(self.name, event)